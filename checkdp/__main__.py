@@ -18,6 +18,8 @@ from checkdp.validate import PSI
 coloredlogs.install('DEBUG', fmt='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
+_HOLE_RE = re.compile(rf'{re.escape(constants.HOLE)}_\d+')
+
 
 def main(argv=tuple(sys.argv[1:])):
     current_folder = pathlib.Path.cwd()
@@ -43,6 +45,12 @@ def main(argv=tuple(sys.argv[1:])):
                             action='store', dest='clang', type=str,
                             default=current_folder / 'klee' / 'deps' / 'llvm-9.0' / 'bin' / 'clang',
                             help='The clang binary path', required=False)
+    arg_parser.add_argument('--lli',
+                            action='store', dest='lli', type=str,
+                            default=current_folder / 'klee' / 'deps' / 'llvm-9.0' / 'bin' / 'lli',
+                            help='The lli binary path, used to directly run the bytecode when generating the bad '
+                                 'outputs, native binaries are compiled instead if lli is not available',
+                            required=False)
     arg_parser.add_argument('-o', '--out',
                             action='store', dest='out', type=str,
                             default=current_folder / 'checkdp-out',
@@ -68,6 +76,10 @@ def main(argv=tuple(sys.argv[1:])):
                             help='Only generate the transformed template')
     arg_parser.add_argument('--enable-shadow', dest='enable_shadow', action='store_true', default=False, required=False,
                             help='Controls whether shadow execution is used or not.')
+    arg_parser.add_argument('--share-alignments', dest='share_alignments', action='store_true', default=False,
+                            required=False,
+                            help='Use the same alignment for all branches of a random variable, which shrinks the '
+                                 'search space but can only find branch-independent alignments.')
 
     arguments = arg_parser.parse_args(argv)
 
@@ -95,17 +107,16 @@ def main(argv=tuple(sys.argv[1:])):
     start = time.time()
     # create a temporary directory for klee output
     with tempfile.TemporaryDirectory(prefix='klee') as temp_dir:
+        clang = None
+        z3_obj = None
+        klee = None
         try:
             clang = Clang(arguments.clang, [arguments.include, pathlib.Path.cwd()])
-            # use Clang to first do syntax check
-            # CAVEAT: the following code does not work on windows, since fp cannot be opened again on windows NT, see
-            # https://docs.python.org/3.8/library/tempfile.html#tempfile.NamedTemporaryFile
-            with tempfile.NamedTemporaryFile('w+') as fp:
-                with open(arguments.file[0], 'r') as original_fp:
-                    source = original_fp.read()
-                fp.write(re.sub(f'{constants.HOLE}_\\d+', '1', source))
-                fp.flush()
-                clang.syntax_check(fp.name)
+            # use Clang to first do syntax check, the custom holes are defined as macros so that the original source
+            # file can be checked directly
+            with open(arguments.file[0], 'r') as original_fp:
+                source = original_fp.read()
+            clang.syntax_check(arguments.file[0], tuple(f'-D{hole}=1' for hole in set(_HOLE_RE.findall(source))))
 
             # preprocess the source file (remove the comments etc that cannot be parsed by plyparser)
             preprocessed_file = output_folder / 'preprocessed.c'
@@ -114,7 +125,7 @@ def main(argv=tuple(sys.argv[1:])):
             # transform the code to a template
             with preprocessed_file.open('r') as file:
                 code = file.read()
-            template = transform(code, arguments.enable_shadow)
+            template = transform(code, arguments.enable_shadow, arguments.share_alignments)
 
             with open(output_folder / 'template.c', 'w') as template_file:
                 template_file.write(template.fill_default(5))
@@ -126,7 +137,7 @@ def main(argv=tuple(sys.argv[1:])):
             z3_obj = Z3(arguments.z3, klee_out)
             klee = KLEE(arguments.klee, arguments.kleaver, z3_obj, klee_out, search_heuristic=arguments.search)
 
-            is_alignment, *rest = core.run(template, klee, clang, output_folder)
+            is_alignment, *rest = core.run(template, klee, clang, output_folder, arguments.lli)
             if is_alignment:
                 alignment = rest[0]
                 logger.info(f'Result: Alignment Found: {template.random_distance(alignment)}')
@@ -172,6 +183,12 @@ def main(argv=tuple(sys.argv[1:])):
                     logger.error('PSI validation failed, ratio of probabilities is still bounded')
                     return 1
         finally:
+            if clang:
+                clang.close()
+            if z3_obj:
+                z3_obj.close()
+            if klee:
+                klee.close()
             logger.info(f'Finished in {time.time() - start} seconds.')
             file_handler.flush()
             logging.getLogger('checkdp').removeHandler(file_handler)
@@ -1,6 +1,13 @@
+from typing import Dict, Optional
+import asyncio
+import hashlib
 import logging
+import os
+import pathlib
+import shutil
 import subprocess
 import sys
+import tempfile
 
 
 logger = logging.getLogger(__name__)
@@ -17,25 +24,99 @@ class Clang:
             self._extra_args.append('-isysroot')
             self._extra_args.append(
                 subprocess.run(['xcrun', '--show-sdk-path'], capture_output=True).stdout.decode('utf-8').strip())
+        # bytecode compiled by compile_bytecode_cached, keyed by the hash of the source and the compiler arguments,
+        # the cached files are kept in a temporary directory (lazily created) which is removed by close
+        self._bc_cache: Dict[bytes, pathlib.Path] = {}
+        self._bc_cache_dir: Optional[tempfile.TemporaryDirectory] = None
 
-    def _compile(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
-        include_args = ('-I{}'.format(include) for include in (self._include_dirs + list(include_dirs)))
-        library_args = ('-L{}'.format(library) for library in (self._library_dirs + list(library_dirs)))
-        command = (self._binary, *include_args, *library_args, *extra_args, '-o', output, source)
-        process = subprocess.run(command, capture_output=True)
-        for output in (process.stdout.decode(), process.stderr.decode()):
+    _BYTECODE_ARGS = ('-emit-llvm', '-g', '-c', '-O0')
+
+    @staticmethod
+    def _check_outputs(*outputs: bytes):
+        for output in outputs:
+            output = output.decode()
             if 'error' in output or 'ERROR' in output:
                 raise ValueError('clang outputs error message: {}'.format(output))
 
+    def _run(self, command):
+        process = subprocess.run(command, capture_output=True)
+        self._check_outputs(process.stdout, process.stderr)
+
+    def _command(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        include_args = ('-I{}'.format(include) for include in (self._include_dirs + list(include_dirs)))
+        library_args = ('-L{}'.format(library) for library in (self._library_dirs + list(library_dirs)))
+        return tuple(map(str, (self._binary, *include_args, *library_args, *extra_args, '-o', output, source)))
+
+    def _compile(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        self._run(self._command(source, output, include_dirs, library_dirs, extra_args))
+
+    async def _async_compile(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        process = await asyncio.create_subprocess_exec(
+            *self._command(source, output, include_dirs, library_dirs, extra_args),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        out, err = await process.communicate()
+        self._check_outputs(out, err)
+
     def compile_binary(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
         logger.debug(f'Compiling {source} to binary using clang')
         self._compile(source, output, include_dirs, library_dirs, extra_args)
 
+    async def async_compile_binary(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        logger.debug(f'Compiling {source} to binary using clang')
+        await self._async_compile(source, output, include_dirs, library_dirs, extra_args)
+
     def compile_bytecode(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
         logger.debug(f'Compiling {source} to bytecode using clang')
-        extra_args = extra_args + ('-emit-llvm', '-g', '-c', '-O0')
+        extra_args = extra_args + self._BYTECODE_ARGS
         self._compile(source, output, include_dirs, library_dirs, extra_args)
 
+    async def async_compile_bytecode(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        logger.debug(f'Compiling {source} to bytecode using clang')
+        extra_args = extra_args + self._BYTECODE_ARGS
+        await self._async_compile(source, output, include_dirs, library_dirs, extra_args)
+
+    def compile_bytecode_cached(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        """Same as compile_bytecode, but the compilation is skipped if the same source has already been compiled with
+        the same arguments, the cached bytecode is kept in a temporary directory until close is called."""
+        extra_args = extra_args + self._BYTECODE_ARGS
+        # the last three arguments are '-o', output and source, which do not affect the generated bytecode
+        arguments = self._command(source, output, include_dirs, library_dirs, extra_args)[:-3]
+        with open(source, 'rb') as f:
+            key = hashlib.sha1(f.read() + b'\0' + '|'.join(arguments).encode('utf-8')).digest()
+
+        output = pathlib.Path(output)
+        cached = self._bc_cache.get(key)
+        if cached is not None and cached.exists():
+            logger.debug(f'Reusing cached bytecode {cached} for {source}')
+            self._link(cached, output)
+            return
+
+        logger.debug(f'Compiling {source} to bytecode using clang')
+        self._compile(source, output, include_dirs, library_dirs, extra_args)
+        if self._bc_cache_dir is None:
+            self._bc_cache_dir = tempfile.TemporaryDirectory(prefix='checkdp-bc')
+        cached = pathlib.Path(self._bc_cache_dir.name) / f'{key.hex()}.bc'
+        self._link(output, cached)
+        self._bc_cache[key] = cached
+
+    @staticmethod
+    def _link(source: pathlib.Path, destination: pathlib.Path):
+        # hard links are constant-time, fall back to copying if not supported
+        if destination.exists():
+            destination.unlink()
+        try:
+            os.link(str(source), str(destination))
+        except OSError:
+            shutil.copyfile(str(source), str(destination))
+
+    def close(self):
+        """remove the cached bytecode"""
+        if self._bc_cache_dir is not None:
+            self._bc_cache_dir.cleanup()
+            self._bc_cache_dir = None
+        self._bc_cache.clear()
+
     def preprocess(self, source, output, include_dirs=(), extra_args=()):
         extra_args = extra_args + (
             # ask clang to preprocess only
@@ -45,8 +126,8 @@ class Clang:
         )
         self._compile(source, output, include_dirs, extra_args=extra_args)
 
-    def syntax_check(self, source):
-        extra_args = (
+    def syntax_check(self, source, extra_args=()):
+        extra_args = extra_args + (
             # ask clang to only do syntax check
             '-fsyntax-only',
             # suppress warnings for annotation strings
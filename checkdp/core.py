@@ -1,12 +1,55 @@
 from pathlib import Path
+import asyncio
+import shutil
 import stat
 import logging
-import subprocess
 
 logger = logging.getLogger(__name__)
 
+# buffer size of the generated source files, large enough to hold a whole program in one write
+_WRITE_BUFFER_SIZE = 1 << 20
 
-def run(template, klee, clang, output_dir=Path.cwd() / 'checkdp-out'):
+
+async def _build_and_run(template, clang, output_dir, index, bad_inputs, lli=None):
+    real_run_inputs = bad_inputs.copy()
+    real_run_inputs.update(template.default_alignment())
+
+    # remove the assertions, because we are supplying a default alignment which will trigger the
+    # assertions if the counterexample is 'valid'
+    counterexample_file = output_dir / f'counterexample_badoutput_{index}.c'
+    with counterexample_file.open('w', buffering=_WRITE_BUFFER_SIZE) as f:
+        f.write('#define CHECKDP_REAL_RUN\n')
+        template.fill_to(f, [real_run_inputs], 5, add_symbolic_cost=False)
+
+    if lli is not None and shutil.which(str(lli)) is not None:
+        # lli directly executes the bytecode, which saves the code generation and linking of a native binary
+        bytecode_file = output_dir / f'badoutput_{index}.bc'
+        await clang.async_compile_bytecode(counterexample_file, bytecode_file)
+        command = (str(lli), str(bytecode_file.resolve()))
+    else:
+        # compile the source file to binary to be executed
+        binary_file = output_dir / f'badoutput_{index}'
+        await clang.async_compile_binary(counterexample_file, binary_file)
+        # add executable permission
+        binary_file.chmod(binary_file.stat().st_mode | stat.S_IEXEC)
+        command = (str(binary_file.resolve()), )
+
+    # run the program and get the output
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    out, err = await process.communicate()
+    logger.debug(f"Violation line in transformed file: {err.decode('utf-8').splitlines()}")
+    return out.decode('utf-8').splitlines()
+
+
+def _concrete_key(concrete):
+    # hashable representation of a concrete, used to compare the sets of concretes, the values are compared by
+    # value so that equal numbers (1 and 1.0) and sequences (lists and tuples) give the same key
+    return frozenset((name, tuple(value) if isinstance(value, (tuple, list)) else value)
+                     for name, value in concrete.items())
+
+
+def run(template, klee, clang, output_dir=Path.cwd() / 'checkdp-out', lli=None):
     found_counterexamples = []
     possible_alignments = [template.default_alignment()]
 
@@ -14,6 +57,9 @@ def run(template, klee, clang, output_dir=Path.cwd() / 'checkdp-out'):
     suffix = 0
     iterations = 0
 
+    # sets of counterexamples that no alignment can cover, any superset of them can not be covered either
+    unsat_counterexamples = []
+
     is_find_inputs = True
     # final validate flag, when we cannot find an alignment that covers all
     is_final_validate = False
@@ -33,19 +79,26 @@ def run(template, klee, clang, output_dir=Path.cwd() / 'checkdp-out'):
         logger.info(f"Now searching for {search_object} with {len(concretes)} concrete "
                     f"{'alignments' if is_find_inputs else 'inputs'}")
 
-        content = '#define CHECKDP_KLEE\n' + template.fill(concretes, 5)
+        concretes_key = frozenset(_concrete_key(concrete) for concrete in concretes)
+        if not is_find_inputs and any(unsat <= concretes_key for unsat in unsat_counterexamples):
+            logger.info('The counterexamples contain a set that no alignment can cover, skipping the search')
+            result = None
+        else:
+            concrete_file = output_dir / f'generate-{search_object}-{suffix}.c'
+            bytecode_file = output_dir / f'generate-{search_object}-{suffix}.bc'
 
-        concrete_file = output_dir / f'generate-{search_object}-{suffix}.c'
-        bytecode_file = output_dir / f'generate-{search_object}-{suffix}.bc'
+            # write the generated program directly to the file, without building the whole source in memory
+            with concrete_file.open('w', buffering=_WRITE_BUFFER_SIZE) as f:
+                f.write('#define CHECKDP_KLEE\n')
+                template.fill_to(f, concretes, 5)
 
-        with concrete_file.open('w') as f:
-            f.write(content)
+            # generate byte code using clang, the generated file may be identical to one of the previous iterations
+            clang.compile_bytecode_cached(str(concrete_file), str(bytecode_file))
 
-        # generate byte code using clang
-        clang.compile_bytecode(str(concrete_file), str(bytecode_file))
-
-        # run klee and get new set of concretes
-        result = klee.run(str(bytecode_file), template.type_system(), is_maximize=is_find_inputs)
+            # run klee and get new set of concretes
+            result = klee.run(str(bytecode_file), template.type_system(), is_maximize=is_find_inputs)
+            if not result and not is_find_inputs:
+                unsat_counterexamples.append(concretes_key)
 
         # four possibilities:
         # (has_result, is_find_inputs) -> found a counterexample, append to list and go to next iteration
@@ -102,27 +155,12 @@ def run(template, klee, clang, output_dir=Path.cwd() / 'checkdp-out'):
 
     # now we try to get the bad outputs by replacing input with the concrete counterexample
     # and alignment with default null alignment, then run the binary using q and q + dq to get two bad outputs
-    bad_outputs = []
-    for index, bad_inputs in enumerate((final_counterexample, template.related_inputs(final_counterexample))):
-        real_run_inputs = bad_inputs.copy()
-        real_run_inputs.update(template.default_alignment())
-
-        # remove the assertions, because we are supplying a default alignment which will trigger the
-        # assertions if the counterexample is 'valid'
-        content = '#define CHECKDP_REAL_RUN\n' + template.fill([real_run_inputs], 5, add_symbolic_cost=False)
-        counterexample_file = output_dir / f'counterexample_badoutput_{index}.c'
-        with counterexample_file.open('w') as f:
-            f.write(content)
-
-        # compile the source file to binary to be executed
-        binary_file = output_dir / f'badoutput_{index}'
-        clang.compile_binary(counterexample_file, binary_file)
-
-        # run the binary and get the output
-        # add executable permission
-        binary_file.chmod(binary_file.stat().st_mode | stat.S_IEXEC)
-        process = subprocess.run(str(binary_file.resolve()), capture_output=True)
-        bad_outputs.append(process.stdout.decode('utf-8').splitlines())
-        logger.debug(f"Violation line in transformed file: {process.stderr.decode('utf-8').splitlines()}")
+    async def build_and_run_all():
+        return await asyncio.gather(*(
+            _build_and_run(template, clang, output_dir, index, bad_inputs, lli)
+            for index, bad_inputs in enumerate((final_counterexample, template.related_inputs(final_counterexample)))
+        ))
+    # the two runs are independent, therefore build and run them in parallel
+    bad_outputs = list(asyncio.run(build_and_run_all()))
 
     return False, final_counterexample, bad_outputs
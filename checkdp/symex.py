@@ -1,16 +1,65 @@
-from typing import List, Union, Optional, Dict, Sequence, Tuple
+from typing import List, Union, Optional, Dict, Sequence, Tuple, FrozenSet
 import asyncio
+import concurrent.futures
+import mmap
+import os
 import pathlib
+import signal
 import shutil
 import struct
+import subprocess
 import logging
 import re
+import uuid
 from checkdp.transform.typesystem import TypeSystem
 import checkdp.transform.constants as constants
 from checkdp.utils import InputType
 
 logger = logging.getLogger(__name__)
 
+# marker echoed by the long-lived z3 process after each query, used to frame the responses
+_END_MARKER = '---END---'
+# values of the queried 32-bit words in the get-value responses of z3
+_Z3_WORD_RE = re.compile(r'#x([0-9a-f]{8})')
+# declarations of the symbolic arrays and their lengths in kquery files
+_KQUERY_ARRAY_RE = re.compile(r'array\s+(\w+)\[(\d+)\]\s')
+# lines of the KLEE log reporting an error
+_ERROR_RE = re.compile(rb'^.*ERROR.*$', re.MULTILINE)
+# number of bytes written to the stdin of a one-shot z3 process before waiting for it to drain
+_DRAIN_SIZE = 64 * 1024
+# a read of a single byte of a symbolic array at a constant index and a constant byte, as printed by kleaver
+_SELECT = r'\(select\s+(?P<{}>\w+)\s+\(_\s+bv(?P<{}>\d+)\s+32\s*\)\s*\)'
+_BYTE = r'(?P<value>#x[0-9a-fA-F]{2}|\(_\s+bv\d+\s+8\s*\))'
+_SELECT_RE = re.compile(_SELECT.format('variable', 'index'))
+# assertions that fix a byte of a symbolic array to a concrete value, the constant can be on either side
+_CONCRETE_BYTE_RES = (
+    re.compile(rf"^\(assert\s+\(=\s+{_BYTE}\s+{_SELECT.format('variable', 'index')}\s*\)\s*\)$"),
+    re.compile(rf"^\(assert\s+\(=\s+{_SELECT.format('variable', 'index')}\s+{_BYTE}\s*\)\s*\)$"),
+)
+
+
+def _concretize(constraints: List[str]) -> List[str]:
+    """substitute the bytes fixed by equality assertions into the other constraints (implied value concretization),
+    the equality assertions themselves are kept so that the values of the bytes can still be queried"""
+    concrete_bytes = {}
+    defining = set()
+    for line_number, constraint in enumerate(constraints):
+        for pattern in _CONCRETE_BYTE_RES:
+            match = pattern.match(constraint)
+            if match and (match.group('variable'), match.group('index')) not in concrete_bytes:
+                concrete_bytes[(match.group('variable'), match.group('index'))] = match.group('value')
+                defining.add(line_number)
+                break
+    if len(concrete_bytes) == 0:
+        return constraints
+
+    def substitute(match):
+        return concrete_bytes.get((match.group('variable'), match.group('index')), match.group())
+
+    return [constraint if line_number in defining or not constraint.startswith('(assert')
+            else _SELECT_RE.sub(substitute, constraint)
+            for line_number, constraint in enumerate(constraints)]
+
 
 class Z3:
     def __init__(self, z3_binary: str, output_dir: pathlib.Path = (pathlib.Path.cwd() / 'klee-out')):
@@ -19,18 +68,45 @@ class Z3:
         # create output folder if not exists
         output_dir.mkdir(exist_ok=True)
         self._output_dir = output_dir
-
-    async def async_solve(self, constraints: List[str], variables_length: Dict[str, int]):
-        # print out the values for the symbolic variables
-        constraints.append('(check-sat)')
-        for variable, length in variables_length.items():
-            for index in range(length):
-                constraints.append(f'(get-value ((select {variable} (_ bv{index} 32))))')
-        constraints.append('(exit)')
-
+        # results of previously solved queries, core.run re-queries overlapping constraint sets across iterations
+        # the constraints themselves (rather than their hashes) are used as keys, since a collision would silently
+        # return the model of another query
+        self._cache: Dict[Tuple[Tuple[str, ...], Tuple[Tuple[str, int], ...]],
+                          Tuple[bool, Dict[str, Sequence[int]]]] = {}
+        # constraint sets known to be unsatisfiable, any superset of them is unsatisfiable as well
+        self._unsat_sets: List[FrozenSet[str]] = []
+        # long-lived z3 process reading SMT-LIB commands from stdin, lazily created on the first query
+        self._process: Optional[subprocess.Popen] = None
+
+    def _interactive_solve(self, commands: List[str]) -> str:
+        """run the commands inside a push / pop frame of the long-lived z3 process and return its responses"""
+        if self._process is None or self._process.poll() is not None:
+            self._process = subprocess.Popen([str(self._binary), '-in'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT, universal_newlines=True)
+        stdin = self._process.stdin
+        stdin.write('(push)\n')
+        for command in commands:
+            # set-logic is only allowed at the beginning and exit would terminate the process
+            if not command.startswith(('(set-logic', '(exit')):
+                stdin.write(command)
+                stdin.write('\n')
+        stdin.write(f'(pop)\n(echo "{_END_MARKER}")\n')
+        stdin.flush()
+
+        responses = []
+        for line in self._process.stdout:
+            if line.strip() == _END_MARKER:
+                return ''.join(responses)
+            responses.append(line)
+        raise BrokenPipeError('z3 process exited unexpectedly')
+
+    async def _file_solve(self, commands: List[str]) -> str:
+        """write the commands to an smt2 file and solve it by a one-shot z3 process, used for debugging"""
         smt2_file = (self._output_dir / 'minmax.smt2')
         with smt2_file.open('w') as fp:
-            fp.write('\n'.join(constraints))
+            for command in commands:
+                fp.write(command)
+                fp.write('\n')
 
         process = await asyncio.subprocess.create_subprocess_exec(
             str(self._binary), str(smt2_file.resolve()), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
@@ -38,28 +114,115 @@ class Z3:
 
         out, err = await process.communicate()
         await process.wait()
+        return out.decode('utf-8')
 
-        # parse the output
-        variable_bytes: Dict[str, bytearray] = {variable: bytearray(length) for variable, length in variables_length.items()}
+    async def _oneshot_solve(self, commands: List[str]) -> str:
+        """stream the commands to the stdin of a one-shot z3 process"""
+        process = await asyncio.subprocess.create_subprocess_exec(
+            str(self._binary), '-in', stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        written = 0
+        for command in commands:
+            process.stdin.write(command.encode('utf-8'))
+            process.stdin.write(b'\n')
+            written += len(command) + 1
+            if written >= _DRAIN_SIZE:
+                await process.stdin.drain()
+                written = 0
+        process.stdin.close()
 
-        is_sat = out.decode('utf-8').split('\n', 1)[0]
-        is_sat = True if is_sat == 'sat' else False
+        out, err = await process.communicate()
+        await process.wait()
+        return out.decode('utf-8')
 
-        for variable, byte_index, value in re.findall(
-                r'\(\(\(select (\w+)\s\(_ bv(\d+) 32\)\) #x([0-9a-f]{2})\)\)', out.decode('utf-8')):
-            variable_bytes[variable][int(byte_index)] = int(value, 16)
+    async def async_solve(self, constraints: List[str], variables_length: Dict[str, int]):
+        key = (tuple(constraints), tuple(sorted(variables_length.items())))
+        if key in self._cache:
+            is_sat, objects = self._cache[key]
+            logger.debug('z3 query cache hit')
+            # return a copy since the caller might modify the objects
+            return is_sat, dict(objects)
+        constraint_set = frozenset(constraints)
+        if any(unsat_set <= constraint_set for unsat_set in self._unsat_sets):
+            logger.debug('z3 query contains a known unsatisfiable constraint set')
+            return False, {}
+
+        # print out the values for the symbolic variables, each variable is queried by a single get-value command
+        # where every 4 bytes are concatenated into one (little-endian) 32-bit integer
+        constraints.append('(check-sat)')
+        for variable, length in variables_length.items():
+            words = []
+            for word_index in range(0, length, 4):
+                word = f'(select {variable} (_ bv{word_index} 32))'
+                for byte_index in range(word_index + 1, word_index + 4):
+                    word = f'(concat (select {variable} (_ bv{byte_index} 32)) {word})'
+                words.append(word)
+            constraints.append(f"(get-value ({' '.join(words)}))")
+        constraints.append('(exit)')
+
+        if os.environ.get('CHECKDP_DEBUG_SMT2') == '1':
+            # keep the query in an smt2 file for debugging purposes
+            out = await self._file_solve(constraints)
+        else:
+            try:
+                out = await asyncio.get_event_loop().run_in_executor(None, self._interactive_solve, constraints)
+            except OSError as error:
+                # the process died, fall back to running a one-shot z3 process
+                logger.warning(f'z3 process failed ({error}), falling back to a one-shot z3 process')
+                self.close()
+                out = await self._oneshot_solve(constraints)
+            else:
+                if out.split('\n', 1)[0] not in ('sat', 'unsat'):
+                    # the long-lived process might be in a bad state, retry with a fresh one-shot z3 process
+                    logger.warning(f'z3 process returned an unexpected result, retrying with a one-shot z3 process, '
+                                   f'full output:\n{out}')
+                    self.close()
+                    out = await self._oneshot_solve(constraints)
+
+        # parse the output, only definite results are returned (and cached), since an unsat result hides all the
+        # supersets of the constraints afterwards
+        result = out.split('\n', 1)[0]
+        if result not in ('sat', 'unsat'):
+            raise ValueError(f'z3 did not return a sat / unsat result, full output:\n{out}')
+        is_sat = result == 'sat'
+
+        # the only hexadecimal literals in the output are the values of the queried words, in the order of the
+        # get-value commands, default to 0 if no model is available
+        words = _Z3_WORD_RE.findall(out)
+        words.extend('00000000' for _ in range(sum(length // 4 for length in variables_length.values()) - len(words)))
+        objects = {}
+        offset = 0
+        for variable, length in variables_length.items():
+            # decode the hexadecimal (big-endian as printed) 32-bit words into tuple of signed ints in one go
+            count = length // 4
+            objects[variable] = struct.unpack(f'>{count}i', bytes.fromhex(''.join(words[offset:offset + count])))
+            offset += count
 
-        # convert the bytearray into tuple of ints or int
-        objects = {variable: None for variable in variable_bytes.keys()}
-        for variable, byte_value in variable_bytes.items():
-            value = tuple(element[0] for element in struct.iter_unpack('i', byte_value))
-            objects[variable] = value
-        return is_sat, objects
+        self._cache[key] = (is_sat, objects)
+        if not is_sat:
+            self._unsat_sets.append(constraint_set)
+        return is_sat, dict(objects)
 
     def solve(self, constraints: List[str], variables_length: Dict[str, int]) \
             -> Tuple[bool, Dict[str, Union[int, Sequence[int]]]]:
         return asyncio.run(self.async_solve(constraints, variables_length))
 
+    def reset(self):
+        """clear all assertions and declarations in the long-lived z3 process"""
+        if self._process is not None and self._process.poll() is None:
+            try:
+                self._process.stdin.write('(reset)\n')
+                self._process.stdin.flush()
+            except OSError:
+                self.close()
+
+    def close(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
 
 class KLEE:
     def __init__(self, klee_binary: str, kleaver_binary: str, z3_obj: Z3,
@@ -74,6 +237,18 @@ class KLEE:
         self._backends = backend if isinstance(backend, (tuple, list)) else (backend,)
         self._search_heuristic = search_heuristic
         self._show_output = show_output
+        # old output directories are renamed away and deleted in the background, see _recycle_output_dir
+        self._deleter = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # partition the available cores evenly among the racing backends so that they do not contend for the same
+        # cores and caches, only supported on Linux, empty if there are not enough cores to go around
+        self._affinity: Dict[str, FrozenSet[int]] = {}
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+            if len(cores) >= len(self._backends) > 1:
+                share = len(cores) // len(self._backends)
+                for index, name in enumerate(self._backends):
+                    end = (index + 1) * share if index != len(self._backends) - 1 else len(cores)
+                    self._affinity[name] = frozenset(cores[index * share:end])
 
     async def _extract_constraints(self, kquery_file: Union[str, pathlib.Path]):
         process = await asyncio.create_subprocess_exec(
@@ -84,10 +259,34 @@ class KLEE:
         await process.wait()
         return out.decode('utf-8')
 
+    @staticmethod
+    def _check_log(log_file: pathlib.Path):
+        """check the KLEE log for errors, the log is memory-mapped and only decoded when an error is reported"""
+        with log_file.open('rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                raise ValueError('KLEE did not finish properly, the log is empty')
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                # check if KLEE doesn't finish properly
+                if content.find(b'KLEE: done') == -1:
+                    raise ValueError(f"KLEE did not finish properly, full log:\n{content[:].decode('utf-8')}")
+                # check if KLEE returned an error that is not the desired ASSERTION FAIL
+                for error_line in _ERROR_RE.finditer(content):
+                    if b'ASSERTION FAIL' not in error_line.group():
+                        raise ValueError(f"KLEE reported an error: {error_line.group().decode('utf-8')}, "
+                                         f"full KLEE log: \n{content[:].decode('utf-8')}")
+
+    def _recycle_output_dir(self):
+        """give a fresh output directory, the old one is renamed and then deleted by a background thread since it can
+        contain thousands of files"""
+        if self._output_dir.exists():
+            old = self._output_dir.with_name(f'{self._output_dir.name}.old.{uuid.uuid4().hex}')
+            os.rename(str(self._output_dir), str(old))
+            self._deleter.submit(shutil.rmtree, str(old), ignore_errors=True)
+        self._output_dir.mkdir()
+
     async def _async_run(self, source: str, type_system: TypeSystem, is_maximize: bool) -> Optional[InputType]:
         # clear the output directory
-        shutil.rmtree(self._output_dir, ignore_errors=True)
-        self._output_dir.mkdir()
+        self._recycle_output_dir()
 
         # create processes (asyncio tasks) to run in different backends
         processes = {}
@@ -97,10 +296,19 @@ class KLEE:
                 f'--solver-backend={backend}', '-use-independent-solver', f'--search={self._search_heuristic}',
                 source
             ]
-            process = await asyncio.create_subprocess_exec(str(self._klee_binary), *args,
-                                                           stdout=asyncio.subprocess.PIPE,
-                                                           stderr=asyncio.subprocess.PIPE)
-            processes[asyncio.create_task(process.communicate())] = backend, process
+            # KLEE logs can be huge, redirect them to a file instead of buffering them through pipes
+            log_file = self._output_dir / f'{backend}.log'
+            with log_file.open('wb') as log:
+                # start KLEE in a new session so that KLEE and all its child processes can be killed together
+                process = await asyncio.create_subprocess_exec(str(self._klee_binary), *args,
+                                                               stdout=log, stderr=subprocess.STDOUT,
+                                                               start_new_session=True)
+            if backend in self._affinity:
+                try:
+                    os.sched_setaffinity(process.pid, self._affinity[backend])
+                except OSError:
+                    """this is fine since the process might have already stopped"""
+            processes[asyncio.create_task(process.wait())] = backend, process, log_file
 
         # wait for any of the process task (with corresponding backend) to finish, and then cancel the other tasks
         done, pending = await asyncio.wait(list(processes.keys()), return_when=asyncio.FIRST_COMPLETED)
@@ -109,26 +317,20 @@ class KLEE:
 
         # first kill all other processes
         for task in pending:
-            backend, process = processes[task]
+            backend, process, _ = processes[task]
             try:
-                process.kill()
+                if hasattr(os, 'killpg'):
+                    os.killpg(process.pid, signal.SIGKILL)
+                else:
+                    process.kill()
             except ProcessLookupError:
                 """this is fine since the process might have already stopped"""
             await process.wait()
 
         # now extract the results from the finished process
-        out, err = await done
-        backend, process = processes[done]
+        backend, process, log_file = processes[done]
         logger.debug(f'backend {backend} returned with a result')
-
-        # KLEE outputs information to the stderr channel, therefore read everything from there
-        content = out.decode('utf-8') + err.decode('utf-8')
-        # check if KLEE doesn't finish properly
-        if 'KLEE: done' not in content:
-            raise ValueError(f'KLEE did not finish properly, full log:\n{content}')
-        # check if KLEE returned an error that is not the desired ASSERTION FAIL
-        for error_line in filter(lambda line: 'ERROR' in line and 'ASSERTION FAIL' not in line, content.splitlines()):
-            raise ValueError(f'KLEE reported an error: {error_line}, full KLEE log: \n{content}')
+        self._check_log(log_file)
 
         solver_output = self._output_dir / backend
         for file in solver_output.glob('*.assert.err'):
@@ -138,34 +340,33 @@ class KLEE:
             kquery_file = solver_output / str(file).replace('.assert.err', '.kquery')
 
             # remove the last two lines: (check-sat) and (exit) since we will be appending other constraints
-            constraints = (await self._extract_constraints(kquery_file)).splitlines()[:-2]
+            constraints = _concretize((await self._extract_constraints(kquery_file)).splitlines()[:-2])
 
             with kquery_file.open('r') as fp:
                 variable_length = {}
-                for match in re.findall(r'array\s+([\w]+)\[(\d+)\]\s', fp.read()):
+                for match in _KQUERY_ARRAY_RE.findall(fp.read()):
                     variable_length[match[0]] = int(match[1])
 
             # add minimize / maximize cost array constraint
             # since cost array is defined as an array of bitvectors, we first need to use `concat` to concatenate
             # every 4 bytes, and then use bvadd to add everything
-            costs = []
-            for byte_index in range(variable_length[constants.SYMBOLIC_COST] // 4):
-                # use concat to form 4 bytes into one cost
-                costs.append(
-                    # here we prepend 8 bytes to prevent overflow when adding up later
-                    f'(concat #x0000 (concat (concat (concat '
-                    f'(select {constants.SYMBOLIC_COST} (_ bv{byte_index * 4} 32)) ' 
-                    f'(select {constants.SYMBOLIC_COST} (_ bv{byte_index * 4 + 1} 32))) ' 
-                    f'(select {constants.SYMBOLIC_COST} (_ bv{byte_index * 4 + 2} 32))) ' 
-                    f'(select {constants.SYMBOLIC_COST} (_ bv{byte_index * 4 + 3} 32))))'
-                )
-
-            # then use bvadd to sum over all costs
-            optimize_constraint = costs.pop()
-            while len(costs) != 0:
-                optimize_constraint = f'(bvadd {costs.pop()} {optimize_constraint})'
+            symbolic_cost = constants.SYMBOLIC_COST
+            cost_length = variable_length[symbolic_cost] // 4 * 4
+            select = [f'(select {symbolic_cost} (_ bv{index} 32))' for index in range(cost_length)]
+
+            # use concat to form 4 bytes into one cost, here we prepend 8 bytes to prevent overflow when adding up later
+            costs = [
+                f'(concat #x0000 (concat (concat (concat {select[byte_index]} {select[byte_index + 1]}) '
+                f'{select[byte_index + 2]}) {select[byte_index + 3]}))'
+                for byte_index in range(0, cost_length, 4)
+            ]
+
+            # then use bvadd to sum over all costs, adding them pairwise so that the final term is a balanced tree
+            while len(costs) > 1:
+                costs = [f'(bvadd {left} {right})' for left, right in zip(costs[::2], costs[1::2])] + \
+                    costs[len(costs) // 2 * 2:]
             keyword = 'maximize' if is_maximize else 'minimize'
-            optimize_constraint = f"({keyword} {optimize_constraint})"
+            optimize_constraint = f"({keyword} {costs[0]})"
             constraints.append(optimize_constraint)
 
             # use z3 to solve the constraints and get the values
@@ -190,4 +391,9 @@ class KLEE:
         return asyncio.run(self._async_run(source, type_system, is_maximize))
 
     def reset(self):
-        shutil.rmtree(self._output_dir)
+        self._recycle_output_dir()
+        self._z3.reset()
+
+    def close(self):
+        """wait for the deletions of the old output directories to finish"""
+        self._deleter.shutdown(wait=True)
@@ -1,6 +1,6 @@
 import logging
 import re
-from checkdp.transform.utils import parse, generate
+from checkdp.transform.utils import parse, generate, branch_free
 from checkdp.transform.preprocess import Preprocessor
 from checkdp.transform.base import Transformer
 from checkdp.transform.random_distance import RandomDistanceGenerator
@@ -10,15 +10,17 @@ import checkdp.transform.constants as constants
 
 logger = logging.getLogger(__name__)
 
+_HOLE_RE = re.compile(rf'{re.escape(constants.HOLE)}_\d+')
 
-def transform(code: str, enable_shadow: bool = False):
+
+def transform(code: str, enable_shadow: bool = False, share_alignments: bool = False):
     node = parse(code)
     # first preprocess the node, extract the annotations and do sanity checks
     logger.info('Transformation starts')
     logger.info('Preprocess starts')
     preprocessed, type_system, preconditions, hole_preconditions, goal = Preprocessor().process(node)
     # TODO: here we use a simple regex to find custom hole variables
-    holes = list(set(re.findall(f'{constants.HOLE}_\\d+', code)))
+    holes = set(_HOLE_RE.findall(code))
     # update the type system with the custom hole variables
     for hole in holes:
         type_system.update_base_type(hole, 'int', False)
@@ -31,12 +33,17 @@ def transform(code: str, enable_shadow: bool = False):
     logger.debug(f'Final goal to check : {goal}')
     logger.info('Core transformation starts')
     transformed, type_system = Transformer(type_system, enable_shadow).transform(preprocessed)
-    templates, alignment_array_types = RandomDistanceGenerator(type_system, enable_shadow).generate_macros(transformed)
+    templates, alignment_array_types = \
+        RandomDistanceGenerator(type_system, enable_shadow, share_alignments).generate_macros(transformed)
     logger.debug(f'alignment array types: {alignment_array_types}')
     logger.info('Core transformation finishes')
     logger.info('Postprocess starts')
     postprocessed, sample_array_size_func = PostProcessor(type_system, custom_variables=holes).process(transformed)
     logger.info('Postprocess finishes')
+    # avoid KLEE forking on the disjunctions / conjunctions in the assumptions, the first precondition is the
+    # query assumption (e.g., ALL_DIFFER) rather than an expression
+    preconditions = preconditions[:1] + [branch_free(precondition) for precondition in preconditions[1:]]
+    hole_preconditions = [branch_free(precondition) for precondition in hole_preconditions]
     code_template = Template(type_system, postprocessed, templates, goal, alignment_array_types, sample_array_size_func,
                              preconditions, holes, hole_preconditions)
     return code_template
@@ -3,12 +3,64 @@ from copy import deepcopy
 from typing import Dict, Union, Sequence, Tuple
 from pycparser import c_ast
 import checkdp.transform.constants as constants
-from checkdp.transform.typesystem import TypeSystem
-from checkdp.transform.utils import parse, generate, expr_simplify, \
+from checkdp.transform.typesystem import TypeSystem, Snapshot
+from checkdp.transform.utils import parse_expr, generate, expr_simplify, clone, distance_name, \
     is_divergent, ExprType, ExpressionReplacer, DistanceGenerator
 
 logger = logging.getLogger(__name__)
 
+# the prefixes of the distance variables, bound to module globals as they are looked up for every assignment
+_ALIGNED_DISTANCE = constants.ALIGNED_DISTANCE
+_SHADOW_DISTANCE = constants.SHADOW_DISTANCE
+
+
+def _fragment(content: str) -> c_ast.Node:
+    """return a fresh copy of the parsed (cached) fragment, which is much cheaper than running the parser again"""
+    return clone(parse_expr(content))
+
+
+def _assignment(name: str, expression: Union[str, c_ast.Node]) -> c_ast.Assignment:
+    """build `name = expression`"""
+    rvalue = _fragment(expression) if isinstance(expression, str) else expression
+    return c_ast.Assignment(op='=', lvalue=c_ast.ID(name=name), rvalue=rvalue)
+
+
+def _declaration(type_name: str, name: str) -> c_ast.Decl:
+    """build `type_name name = 0`"""
+    declaration = _fragment(f'{type_name} {constants.PREFIX}_DECLARATION = 0')
+    declaration.name = name
+    declaration.type.declname = name
+    return declaration
+
+
+def _sampling_cost(distance: str, scale: str) -> str:
+    """return the simplified privacy cost |distance| / scale of a sampling command, the scales are usually the same
+    across the sampling commands (e.g., 1.0 / epsilon), so the simplification is mostly served by the cache of
+    expr_simplify"""
+    return expr_simplify(f'(Abs({distance}) * (1 / ({scale})))')
+
+
+def _copy_statements(node: c_ast.Node) -> c_ast.Node:
+    """copy the statement skeleton of the AST, i.e., the nodes that the Transformer modifies (the block item lists,
+    the branches and the declarations whose initial values are replaced). The expressions are never modified in place
+    and are therefore shared with the original AST. The function signature is fully copied as well, since the
+    parameters and the return type are changed afterwards (see PostProcessor)."""
+    if isinstance(node, c_ast.FuncDecl):
+        return clone(node)
+    if not isinstance(node, (c_ast.FuncDef, c_ast.Compound, c_ast.If, c_ast.While, c_ast.Decl)):
+        return node
+    copied = object.__new__(node.__class__)
+    for attribute in node.__slots__:
+        if attribute == '__weakref__':
+            continue
+        value = getattr(node, attribute)
+        if isinstance(value, c_ast.Node):
+            value = _copy_statements(value)
+        elif attribute == 'block_items' and value is not None:
+            value = [_copy_statements(child) for child in value]
+        setattr(copied, attribute, value)
+    return copied
+
 
 class _ShadowBranchGenerator(c_ast.NodeVisitor):
     """ this class generates the shadow branch statement"""
@@ -24,17 +76,16 @@ class _ShadowBranchGenerator(c_ast.NodeVisitor):
 
     def visit_Compound(self, node: c_ast.Compound):
         # TODO: currently doesn't support ArrayRef
-        # only generate shadow execution for dynamically tracked variables
-        node.block_items = [child for child in node.block_items
-                            if isinstance(child, c_ast.Assignment) and child.lvalue.name in self._shadow_variables]
-        for child in node:
-            if isinstance(child, c_ast.Assignment):
+        # only generate shadow execution for dynamically tracked variables, the other statements are dropped
+        block_items = []
+        for child in node.block_items:
+            if isinstance(child, c_ast.Assignment) and child.lvalue.name in self._shadow_variables:
                 child.rvalue = c_ast.BinaryOp(op='-', left=self._expression_replacer.visit(child.rvalue),
                                               right=c_ast.ID(name=child.lvalue.name))
                 # change the assignment variable name to shadow distance variable
-                child.lvalue.name = f'{constants.SHADOW_DISTANCE}_{child.lvalue.name}'
-            else:
-                self.visit(child)
+                child.lvalue.name = distance_name(_SHADOW_DISTANCE, child.lvalue.name)
+                block_items.append(child)
+        node.block_items = block_items
 
 
 class Transformer(c_ast.NodeVisitor):
@@ -53,6 +104,9 @@ class Transformer(c_ast.NodeVisitor):
         # we keep tracks of the parent of each node since pycparser doesn't provide this feature, this is useful
         # for easy trace back
         self._parents: Dict[c_ast.Node, c_ast.Compound] = {}
+        # the positions of the children in their parents' block_items (keyed by the ids of the children), used to avoid
+        # linear scans when inserting statements, see _index_of
+        self._child_index: Dict[c_ast.Compound, Dict[int, int]] = {}
         # indicate the level of loop statements, this is needed in While statement, since transformation
         # shouldn't be done until types have converged
         self._loop_level = 0
@@ -61,78 +115,125 @@ class Transformer(c_ast.NodeVisitor):
         self._pc = False
         # this indicates if shadow execution should be used or not
         self._enable_shadow = enable_shadow
+        # the versions of distance variables to generate, shadow distances are only needed when shadow is enabled
+        self._versions = (constants.ALIGNED_DISTANCE, constants.SHADOW_DISTANCE) if enable_shadow else \
+            (constants.ALIGNED_DISTANCE, )
+        # the same expressions are repeatedly checked under the same types (e.g., in the iterations of While loops),
+        # therefore the results are cached by the expression node and the snapshot of the types, the node itself
+        # (rather than its id) is used so that it is kept alive and the key cannot be reused by another node
+        self._divergence_cache: Dict[Tuple[c_ast.Node, Snapshot], Tuple[bool, bool]] = {}
+        self._distance_cache: Dict[Tuple[c_ast.Node, Snapshot], Tuple[str, str]] = {}
+
+    def _is_divergent(self, types: TypeSystem, condition: ExprType) -> Tuple[bool, bool]:
+        key = (condition, types.snapshot())
+        if key not in self._divergence_cache:
+            self._divergence_cache[key] = tuple(is_divergent(types, condition))
+        return self._divergence_cache[key]
+
+    def _distance(self, expression: ExprType) -> Tuple[str, str]:
+        key = (expression, self._type_system.snapshot())
+        if key not in self._distance_cache:
+            self._distance_cache[key] = tuple(DistanceGenerator(self._type_system).visit(expression))
+        return self._distance_cache[key]
 
     def _update_pc(self, pc: bool, types: TypeSystem, condition: ExprType) -> bool:
         if not self._enable_shadow:
             return False
         if pc:
             return True
-        _, is_shadow_divergent = is_divergent(types, condition)
+        _, is_shadow_divergent = self._is_divergent(types, condition)
         return is_shadow_divergent
 
     # Instrumentation rule
     def _instrument(self, type_system_1: TypeSystem, type_system_2: TypeSystem, pc: bool) -> Sequence[c_ast.Assignment]:
         inserted_statement = []
+        # do not instrument anything if enable_shadow is not specified
+        if not self._enable_shadow:
+            return inserted_statement
 
-        for name in set(type_system_1.names()).intersection(type_system_2.names()):
+        # do not instrument shadow statements if pc = True
+        versions = self._versions[:1] if pc else self._versions
+        for name in type_system_1.name_set() & type_system_2.name_set():
             for version, distance_1, distance_2 in zip(
-                    (constants.ALIGNED_DISTANCE, constants.SHADOW_DISTANCE),
-                    type_system_1.get_types(name),
-                    type_system_2.get_types(name)
-            ):
+                    versions, type_system_1.get_types(name), type_system_2.get_types(name)):
                 if distance_1 is None or distance_2 is None:
                     continue
-                # do not instrument shadow statements if pc = True or enable_shadow is not specified
-                if not self._enable_shadow or (version == constants.SHADOW_DISTANCE and pc):
-                    continue
                 if distance_1 != '*' and distance_2 == '*':
-                    inserted_statement.append(parse(f'{version}_{name} = {distance_1}'))
+                    inserted_statement.append(_assignment(distance_name(version, name), distance_1))
 
         return inserted_statement
 
+    def _index_of(self, parent: c_ast.Compound, node: c_ast.Node) -> int:
+        block_items = parent.block_items
+        index = self._child_index.get(parent, {}).get(id(node))
+        # the block_items can also be modified outside of _insert_at, rebuild the index map if it is out of date
+        if index is None or index >= len(block_items) or block_items[index] is not node:
+            self._child_index[parent] = {id(child): position for position, child in enumerate(block_items)}
+            if id(node) not in self._child_index[parent]:
+                raise ValueError('The node is not in the block items of its parent')
+            index = self._child_index[parent][id(node)]
+        return index
+
     def _insert_at(self, node: c_ast.Node, inserted: Union[c_ast.Node, Sequence[c_ast.Node]], after=True):
         parent = self._parents[node]
         if not isinstance(parent, c_ast.Compound):
             raise ValueError('The parent node of the inserted node is not Compound')
-        index = parent.block_items.index(node) + 1 if after else parent.block_items.index(node)
+        index = self._index_of(parent, node) + 1 if after else self._index_of(parent, node)
         if isinstance(inserted, c_ast.Node):
             parent.block_items.insert(index, inserted)
         else:
             parent.block_items[index:index] = inserted
+        # only the positions starting from the inserted statements are changed
+        indices = self._child_index[parent]
+        for position in range(index, len(parent.block_items)):
+            indices[id(parent.block_items[position])] = position
 
     def _assign(self, variable: Union[c_ast.ID, c_ast.ArrayRef], expression: ExprType, node: c_ast.Node):
         """T-Asgn rule, which can be re-used both in Assignment node and Decl node"""
         # get new distance from the assignment expression (T-Asgn)
         variable_name = variable.name if isinstance(variable, c_ast.ID) else variable.name.name
         var_aligned, var_shadow, *_ = self._type_system.get_types(variable_name)
-        aligned, shadow = DistanceGenerator(self._type_system).visit(expression)
+        aligned, shadow = self._distance(expression)
         if self._loop_level == 0:
+            # the statements inserted before / after the node, which are spliced into the block items at once
+            inserts_before, inserts_after = [], []
             # insert x^align = n^align if x^aligned is *
             if var_aligned == '*' or aligned != '0':
-                self._insert_at(node, parse(f'{constants.ALIGNED_DISTANCE}_{variable_name} = {aligned}'), after=True)
+                inserts_after.append(_assignment(distance_name(_ALIGNED_DISTANCE, variable_name), aligned))
 
             if self._enable_shadow:
                 # generate x^shadow = x + x^shadow - e according to (T-Asgn)
                 if self._pc:
                     if isinstance(variable, c_ast.ID):
-                        shadow_distance = c_ast.ID(name=f'{constants.SHADOW_DISTANCE}_{variable_name}')
+                        shadow_distance = c_ast.ID(name=distance_name(_SHADOW_DISTANCE, variable_name))
                     elif isinstance(variable, c_ast.ArrayRef):
-                        shadow_distance = c_ast.ArrayRef(name=f'{constants.SHADOW_DISTANCE}_{variable_name}',
+                        shadow_distance = c_ast.ArrayRef(name=distance_name(_SHADOW_DISTANCE, variable_name),
                                                          subscript=variable.subscript)
                     else:
                         raise NotImplementedError(f'Assigned value type not supported {type(variable)}')
                     # insert x^shadow = x + x^shadow - e;
                     insert_node = c_ast.Assignment(op='=', lvalue=shadow_distance, rvalue=c_ast.BinaryOp(
                         op='-', left=c_ast.BinaryOp(op='+', left=variable, right=shadow_distance), right=expression))
-                    self._insert_at(node, insert_node, after=False)
-                # insert x^shadow = n^shadow if n^shadow is not 0
+                    inserts_before.append(insert_node)
+                # insert x^shadow = n^shadow if n^shadow is not 0, right after the node (i.e., before x^align update)
                 elif var_shadow == '*' or shadow != '0':
-                    self._insert_at(node, parse(f'{constants.SHADOW_DISTANCE}_{variable_name} = {shadow}'), after=True)
+                    inserts_after.insert(
+                        0, _assignment(distance_name(_SHADOW_DISTANCE, variable_name), shadow))
+
+            if inserts_before:
+                self._insert_at(node, inserts_before, after=False)
+            if inserts_after:
+                self._insert_at(node, inserts_after, after=True)
 
         shadow_distance = '*' if self._pc or shadow != '0' or var_shadow == '*' else '0'
         aligned_distance = '*' if aligned != '0' or var_aligned == '*' else '0'
         self._type_system.update_distance(variable_name, aligned_distance, shadow_distance)
 
+    @staticmethod
+    def _replace_condition(condition: ExprType, types: TypeSystem, is_aligned: bool) -> ExprType:
+        """return e^aligned or e^shadow of the condition under the given types, the condition itself is untouched"""
+        return ExpressionReplacer(types, is_aligned).rewrite(condition)
+
     def visit_Compound(self, node: c_ast.Compound):
         # this is needed as we will modify the lists while we're still traversing
         # make a shallow copy of its children and start traverse
@@ -145,8 +246,8 @@ class Transformer(c_ast.NodeVisitor):
         # the start of the transformation
         logger.info(f'Start transforming function {node.decl.name} ...')
 
-        # make a deep copy and transform on the copied node
-        node = deepcopy(node)
+        # copy the statements and transform on the copied node, the input node is left untouched
+        node = _copy_statements(node)
 
         self._parameters = tuple(decl.name for decl in node.decl.type.args.params)
         logger.debug(f'Params: {self._parameters}')
@@ -156,20 +257,18 @@ class Transformer(c_ast.NodeVisitor):
 
         insert_statements = [
             # insert float CHECKDP_v_epsilon = 0;
-            parse(f'float {constants.V_EPSILON} = 0'),
+            _declaration('float', constants.V_EPSILON),
             # insert int SAMPLE_INDEX = 0;
-            parse(f'int {constants.SAMPLE_INDEX} = 0')
+            _declaration('int', constants.SAMPLE_INDEX)
         ]
 
         # add declarations of distance variables for dynamically tracked local variables
         for name, *distances, _, _ in filter(
                 lambda variable: variable[0] not in self._parameters, self._type_system.variables()):
-            for version, distance in zip((constants.ALIGNED_DISTANCE, constants.SHADOW_DISTANCE), distances):
-                # skip shadow generation if enable_shadow is not specified
-                if version == constants.SHADOW_DISTANCE and not self._enable_shadow:
-                    continue
-                if distance == '*' or distance == f'{version}_{name}':
-                    insert_statements.append(parse(f'float {version}_{name} = 0'))
+            # shadow distances are skipped by self._versions if enable_shadow is not specified
+            for version, distance in zip(self._versions, distances):
+                if distance == '*' or distance == distance_name(version, name):
+                    insert_statements.append(_declaration('float', distance_name(version, name)))
 
         # prepend the inserted statements
         node.body.block_items[:0] = insert_statements
@@ -212,14 +311,19 @@ class Transformer(c_ast.NodeVisitor):
 
             if self._enable_shadow:
                 # since we have to dynamically switch (the aligned distances) to shadow version, we have to guard the
-                # switch with the selector
-                shadow_type_system = deepcopy(self._type_system)
-                for name, _, shadow_distance, _, _ in shadow_type_system.variables():
+                # switch with the selector, i.e., merge the types whose aligned distances are replaced by the shadow
+                # distances, which is done in place in a single pass over the variables
+                for name, aligned_distance, shadow_distance, _, _ in tuple(self._type_system.variables()):
                     # skip the distance of custom holes
                     if constants.HOLE in name:
-                        continue
-                    shadow_type_system.update_distance(name, shadow_distance, shadow_distance)
-                self._type_system.merge(shadow_type_system)
+                        switched_distance = aligned_distance
+                    elif shadow_distance not in ('0', '*'):
+                        raise ValueError(f'Distance can only be 0 or *, got {(shadow_distance, shadow_distance)}')
+                    else:
+                        switched_distance = shadow_distance
+                    self._type_system.update_distance(
+                        name, '0' if aligned_distance == switched_distance == '0' else '*',
+                        '0' if shadow_distance == '0' else '*')
 
             if self._loop_level == 0:
                 to_inserts = []
@@ -229,24 +333,26 @@ class Transformer(c_ast.NodeVisitor):
                     distance_update_statements = []
                     for name, align, shadow, _, _ in self._type_system.variables():
                         if align == '*' and name not in self._parameters and name != node.name:
-                            shadow_distance = f'{constants.SHADOW_DISTANCE}_{name}' if shadow == '*' else shadow
+                            shadow_distance = \
+                                distance_name(constants.SHADOW_DISTANCE, name) if shadow == '*' else shadow
                             distance_update_statements.append(
-                                parse(f'{constants.ALIGNED_DISTANCE}_{name} = {shadow_distance};'))
+                                _assignment(distance_name(constants.ALIGNED_DISTANCE, name), shadow_distance))
                     distance_update = c_ast.If(
-                        cond=parse(f'{constants.SELECTOR}_{node.name} == {constants.SELECT_SHADOW}'),
+                        cond=c_ast.BinaryOp(op='==', left=c_ast.ID(name=f'{constants.SELECTOR}_{node.name}'),
+                                            right=c_ast.Constant(type='int', value=constants.SELECT_SHADOW)),
                         iftrue=c_ast.Compound(block_items=distance_update_statements),
                         iffalse=None
                     )
                     to_inserts.append(distance_update)
 
                 # insert distance template for the variable
-                distance = parse(
-                    f'{constants.ALIGNED_DISTANCE}_{node.name} = {constants.RANDOM_DISTANCE}_{node.name}')
+                distance = _assignment(distance_name(constants.ALIGNED_DISTANCE, node.name),
+                                       c_ast.ID(name=f'{constants.RANDOM_DISTANCE}_{node.name}'))
                 to_inserts.append(distance)
 
                 # insert cost variable update statement
                 scale = generate(node.init.args.exprs[0])
-                cost = expr_simplify(f'(Abs({constants.ALIGNED_DISTANCE}_{node.name}) * (1 / ({scale})))')
+                cost = _sampling_cost(distance_name(constants.ALIGNED_DISTANCE, node.name), scale)
                 # calculate v_epsilon by combining normal cost and sampling cost
                 if self._enable_shadow:
                     previous_cost = \
@@ -254,12 +360,14 @@ class Transformer(c_ast.NodeVisitor):
                 else:
                     previous_cost = constants.V_EPSILON
 
-                v_epsilon = parse(f'{constants.V_EPSILON} = {previous_cost} + {cost}')
+                v_epsilon = _assignment(constants.V_EPSILON, f'{previous_cost} + {cost}')
                 to_inserts.append(v_epsilon)
 
                 # transform sampling command to havoc command
-                node.init = parse(f'{constants.SAMPLE_ARRAY}[{constants.SAMPLE_INDEX}]')
-                to_inserts.append(parse(f'{constants.SAMPLE_INDEX} = {constants.SAMPLE_INDEX} + 1;'))
+                node.init = c_ast.ArrayRef(name=c_ast.ID(name=constants.SAMPLE_ARRAY),
+                                           subscript=c_ast.ID(name=constants.SAMPLE_INDEX))
+                to_inserts.append(_assignment(constants.SAMPLE_INDEX, c_ast.BinaryOp(
+                    op='+', left=c_ast.ID(name=constants.SAMPLE_INDEX), right=c_ast.Constant(type='int', value='1'))))
 
                 self._insert_at(node, to_inserts)
         else:
@@ -276,10 +384,11 @@ class Transformer(c_ast.NodeVisitor):
         self._pc = self._update_pc(self._pc, self._type_system, node.cond)
 
         # backup the current types before entering the true or false branch
-        before_types = deepcopy(self._type_system)
+        before_types = self._type_system.copy()
+        # to be used in if branch transformation assert(e^aligned), the conditions are only needed (and therefore
+        # lazily generated) outside of the fixed-point iterations of loops and when the branch is aligned-divergent
+        entry_snapshot = self._type_system.snapshot() if self._loop_level == 0 else None
 
-        # to be used in if branch transformation assert(e^aligned);
-        aligned_true_cond = ExpressionReplacer(self._type_system, True).visit(deepcopy(node.cond))
         self.visit(node.iftrue)
         true_types = self._type_system
         logger.debug(f'types(true branch): {true_types}')
@@ -290,17 +399,15 @@ class Transformer(c_ast.NodeVisitor):
         if node.iffalse:
             logger.debug(f'Line: {node.iffalse.coord.line} else')
             self.visit(node.iffalse)
-        # to be used in else branch transformation assert(not (e^aligned));
-        aligned_false_cond = ExpressionReplacer(self._type_system, True).visit(deepcopy(node.cond))
         logger.debug(f'types(false branch): {self._type_system}')
-        false_types = deepcopy(self._type_system)
+        false_types = self._type_system.copy()
         self._type_system.merge(true_types)
         logger.debug(f'types(after merge): {self._type_system}')
 
         if self._loop_level == 0:
             if self._enable_shadow and self._pc and not before_pc:
                 # insert c_shadow
-                shadow_cond = ExpressionReplacer(self._type_system, False).visit(deepcopy(node.cond))
+                shadow_cond = self._replace_condition(node.cond, self._type_system, False)
                 shadow_branch = c_ast.If(
                     cond=shadow_cond, iftrue=c_ast.Compound(block_items=deepcopy(node.iftrue.block_items)),
                     iffalse=c_ast.Compound(block_items=deepcopy(node.iffalse.block_items)) if node.iffalse else None)
@@ -314,14 +421,21 @@ class Transformer(c_ast.NodeVisitor):
             node.iffalse = node.iffalse if node.iffalse else c_ast.Compound(block_items=[])
 
             # insert assert functions to corresponding branch
-            is_aligned_divergent, _ = is_divergent(self._type_system, node.cond)
-            for aligned_cond, block_items in zip((aligned_true_cond, aligned_false_cond),
-                                                 (node.iftrue.block_items, node.iffalse.block_items)):
-                # insert the assertion
-                assert_body = c_ast.ExprList(exprs=[aligned_cond]) if aligned_cond is aligned_true_cond else \
-                    c_ast.UnaryOp(op='!', expr=c_ast.ExprList(exprs=[aligned_cond]))
-                if is_aligned_divergent:
-                    block_items.insert(0, c_ast.FuncCall(name=c_ast.ID(constants.ASSERT), args=assert_body))
+            is_aligned_divergent, _ = self._is_divergent(self._type_system, node.cond)
+            if is_aligned_divergent:
+                # assert(e^aligned) in the true branch uses the types before the branch, and assert(not (e^aligned))
+                # in the false branch uses the types after the false branch, which are often the same
+                entry_types = TypeSystem()
+                entry_types.restore(entry_snapshot)
+                aligned_true_cond = self._replace_condition(node.cond, entry_types, True)
+                aligned_false_cond = clone(aligned_true_cond) if false_types.snapshot() == entry_snapshot else \
+                    self._replace_condition(node.cond, false_types, True)
+                # insert the assertions
+                node.iftrue.block_items.insert(0, c_ast.FuncCall(
+                    name=c_ast.ID(constants.ASSERT), args=c_ast.ExprList(exprs=[aligned_true_cond])))
+                node.iffalse.block_items.insert(0, c_ast.FuncCall(
+                    name=c_ast.ID(constants.ASSERT),
+                    args=c_ast.UnaryOp(op='!', expr=c_ast.ExprList(exprs=[aligned_false_cond]))))
 
             # instrument statements for updating aligned or shadow distance variables (Instrumentation rule)
             for types in (true_types, false_types):
@@ -335,16 +449,25 @@ class Transformer(c_ast.NodeVisitor):
         before_pc = self._pc
         self._pc = self._update_pc(self._pc, self._type_system, node.cond)
 
-        before_types = deepcopy(self._type_system)
+        before_types = self._type_system.copy()
 
-        fixed_types = None
+        # the types are copied by the cheap snapshots, no statements are inserted while _loop_level > 0, therefore
+        # the iterations only update the type system
+        fixed_types = TypeSystem()
         # don't output logs while doing iterations
         logger.disabled = True
         self._loop_level += 1
-        while fixed_types != self._type_system:
-            fixed_types = deepcopy(self._type_system)
+        is_fixed = False
+        while not is_fixed:
+            types, revision = self._type_system, self._type_system.revision
+            fixed_types.restore(types.snapshot())
             self.generic_visit(node)
             self._type_system.merge(fixed_types)
+            # the unchanged revision cheaply tells that a fixed point is reached, the types are only compared when
+            # they might have changed (e.g., replaced by the If statements or changed and changed back), regardless of
+            # the order of the variables
+            is_fixed = (self._type_system is types and self._type_system.revision == revision) or \
+                self._type_system == fixed_types
         logger.disabled = False
         self._loop_level -= 1
 
@@ -353,15 +476,15 @@ class Transformer(c_ast.NodeVisitor):
             logger.debug(f'types(fixed point): {self._type_system}')
 
             # generate assertion under While if aligned distance is not zero
-            is_aligned_divergent, _ = is_divergent(self._type_system, node.cond)
+            is_aligned_divergent, _ = self._is_divergent(self._type_system, node.cond)
             if is_aligned_divergent:
-                aligned_cond = ExpressionReplacer(self._type_system, True).visit(deepcopy(node.cond))
+                aligned_cond = self._replace_condition(node.cond, self._type_system, True)
                 assertion = c_ast.FuncCall(name=c_ast.ID(constants.ASSERT), args=c_ast.ExprList(exprs=[aligned_cond]))
                 node.stmt.block_items.insert(0, assertion)
 
             self.generic_visit(node)
-            after_visit = deepcopy(self._type_system)
-            self._type_system = deepcopy(before_types)
+            after_visit = self._type_system.copy()
+            self._type_system = before_types.copy()
             self._type_system.merge(fixed_types)
 
             # instrument c_s part
@@ -382,12 +505,14 @@ class Transformer(c_ast.NodeVisitor):
     def visit_FuncCall(self, node: c_ast.FuncCall):
         """T-Return rule, which adds assertion after the OUTPUT command."""
         if self._loop_level == 0 and node.name.name == constants.OUTPUT:
-            distance_generator = DistanceGenerator(self._type_system)
             # add assertion of the output distance == 0
-            aligned_distance = distance_generator.visit(node.args.exprs[0])[0]
+            aligned_distance, _ = self._distance(node.args.exprs[0])
             # there is no need to add assertion if the distance is obviously 0
             if aligned_distance != '0':
-                self._insert_at(node, parse(f'{constants.ASSERT}({aligned_distance} == 0)'))
+                assertion = c_ast.BinaryOp(op='==', left=_fragment(aligned_distance),
+                                           right=c_ast.Constant(type='int', value='0'))
+                self._insert_at(node, c_ast.FuncCall(name=c_ast.ID(name=constants.ASSERT),
+                                                     args=c_ast.ExprList(exprs=[assertion])))
 
         self.generic_visit(node)
 
@@ -396,5 +521,5 @@ class Transformer(c_ast.NodeVisitor):
             raise TypeError('Input node must have type c_ast.FuncDef, try to preprocess the node first.')
         transformed = self.visit_FuncDef(node)
         # add returning the final cost variable
-        transformed.body.block_items.append(parse(f'return {constants.V_EPSILON};'))
+        transformed.body.block_items.append(c_ast.Return(expr=c_ast.ID(name=constants.V_EPSILON)))
         return transformed, self._type_system
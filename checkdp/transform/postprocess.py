@@ -3,7 +3,7 @@ from copy import deepcopy
 from typing import Iterable, Tuple, Callable
 import pycparser.c_ast as c_ast
 import checkdp.transform.constants as constants
-from checkdp.transform.utils import parse, NodeFinder
+from checkdp.transform.utils import parse, NodeFinder, distance_name
 from checkdp.transform.typesystem import TypeSystem
 
 logger = logging.getLogger(__name__)
@@ -17,10 +17,13 @@ class PostProcessor(c_ast.NodeVisitor):
         self._sample_array_size_constants = 0
         self._parameters = None
         self._custom_varaibles = custom_variables
+        # finds the size parameter in the loop conditions, built once the parameters are known
+        self._size_finder = None
 
     def visit_FuncDef(self, node: c_ast.FuncDef) -> c_ast.FuncDef:
         self._parameters = tuple(decl.name for decl in node.decl.type.args.params)
-        query = self._parameters[0]
+        query, size, *_ = self._parameters
+        self._size_finder = NodeFinder(lambda n: isinstance(n, c_ast.ID) and n.name == size)
         # if it is a dynamically tracked parameter, add new parameters
         # add distance variables for dynamically tracked parameters
         for name in self._parameters:
@@ -29,11 +32,11 @@ class PostProcessor(c_ast.NodeVisitor):
                 version = constants.ALIGNED_DISTANCE if index == 0 else constants.SHADOW_DISTANCE
                 if distance == '*':
                     _, _, plain_type, is_array = self._type_system.get_types(name)
-                    distance_variable = f'{plain_type} {version}_{name}'
+                    distance_variable = f'{plain_type} {distance_name(version, name)}'
                     distance_variable = distance_variable + '[]' if is_array else distance_variable
                     node.decl.type.args.params.append(parse(distance_variable))
                     # add the plain type to the type system
-                    self._type_system.update_base_type(f'{version}_{name}', plain_type, is_array)
+                    self._type_system.update_base_type(distance_name(version, name), plain_type, is_array)
                     if name == query:
                         # only generate aligned distance for query variable
                         break
@@ -58,9 +61,7 @@ class PostProcessor(c_ast.NodeVisitor):
         return node
 
     def visit_While(self, node: c_ast.While):
-        _, size, *_ = self._parameters
-        finder = NodeFinder(lambda n: isinstance(n, c_ast.ID) and n.name == size)
-        has_size_variable = len(finder.visit(node.cond)) != 0
+        has_size_variable = len(self._size_finder.visit(node.cond)) != 0
         if has_size_variable:
             self._sized_loop_level += 1
         self.generic_visit(node)
@@ -1,15 +1,43 @@
 import logging
-from copy import deepcopy
-from typing import Union, Tuple, Iterable, Dict, Set
+from copy import copy
+from typing import Union, Tuple, Iterable, Dict, Set, Optional
 import pycparser.c_ast as c_ast
+import math
 import re
 import sympy as sp
 from checkdp.transform.typesystem import TypeSystem
 import checkdp.transform.constants as constants
-from checkdp.transform.utils import generate, parse, expr_simplify
+from checkdp.transform.utils import generate, parse, expr_simplify, clone
 
 logger = logging.getLogger(__name__)
 
+# regular expressions for parsing the annotations
+_TYPE_RE = re.compile(r'([a-zA-Z_]\w*):<([0*]),([0*])>(?:;)?')
+_PRECONDITION_RE = re.compile(r'PRECONDITION:(ONE_DIFFER|ALL_DIFFER|DECREASING|INCREASING)')
+# matches both ASSUME(...) and ASSUME_HOLE(...), so that the precondition string is scanned only once
+_ASSUME_RE = re.compile(r'ASSUME(_HOLE)?\(([^()]*)\)')
+_CHECK_RE = re.compile(r'CHECK:(?:\()?([^();]+)(?:\))?')
+# the variable types supported by KLEE, the other types are changed to int
+_SUPPORTED_TYPES = frozenset(('int', ))
+
+# the inverse of an integer noise scale, e.g., 1 / (2)
+_INTEGER_SCALE_RE = re.compile(r'1 / \(([1-9]\d*)\)')
+
+
+def _integer_lcm(scales: Iterable[str], goal: str) -> Optional[int]:
+    """return the lcm of the denominators of the inverse scales and the goal without sympy, if all scales are integers
+    and the goal contains no divisions (i.e., its denominator is 1), otherwise return None"""
+    if '/' in goal or '**' in goal:
+        return None
+    lcm = 1
+    for scale in scales:
+        match = _INTEGER_SCALE_RE.fullmatch(scale)
+        if not match:
+            return None
+        denominator = int(match.group(1))
+        lcm = lcm * denominator // math.gcd(lcm, denominator)
+    return lcm
+
 
 def parse_annotation(type_str: str, precondition_str: str, check_str: str):
     """Parse the annotation strings and return the results, with sanity checks.
@@ -18,31 +46,26 @@ def parse_annotation(type_str: str, precondition_str: str, check_str: str):
     # robust instead of regular expressions, and can also give position information about where the error is
 
     # remove white spaces and line breaks in the annotation strings
-    space_re = re.compile(r'\s*')
     type_str, precondition_str, check_str = \
-        space_re.sub('', type_str), space_re.sub('', precondition_str), space_re.sub('', check_str)
+        ''.join(type_str.split()), ''.join(precondition_str.split()), ''.join(check_str.split())
 
     # regular expression to extract all types
     initial_types = {
         variable: (aligned_distance, shadow_distance) for variable, aligned_distance, shadow_distance in
-        map(lambda match: match.groups(), re.finditer(r'([a-zA-Z_]\w*):<([0*]),([0*])>(?:;)?', type_str))}
+        map(lambda match: match.groups(), _TYPE_RE.finditer(type_str))}
 
     try:
-        preconditions = \
-            [re.match(r'PRECONDITION:(ONE_DIFFER|ALL_DIFFER|DECREASING|INCREASING)', precondition_str).group(1)]
+        preconditions = [_PRECONDITION_RE.match(precondition_str).group(1)]
     except AttributeError:
         raise ValueError('Precondition annotation does not contain sensitivity information, specify with either '
                          'ONE_DIFFER or ALL_DIFFER')
 
-    for assume in re.finditer(r'ASSUME\(([^()]*)\)', precondition_str):
-        preconditions.append(assume.group(1))
-
     hole_preconditions = []
-    for assume in re.finditer(r'ASSUME_HOLE\(([^()]*)\)', precondition_str):
-        hole_preconditions.append(assume.group(1))
+    for is_hole, assume in _ASSUME_RE.findall(precondition_str):
+        (hole_preconditions if is_hole else preconditions).append(assume)
 
     try:
-        check = re.match(r'CHECK:(?:\()?([^();]+)(?:\))?', check_str).group(1)
+        check = _CHECK_RE.match(check_str).group(1)
     except AttributeError:
         raise ValueError(f'Check annotation is invalid: {check_str}')
 
@@ -64,11 +87,12 @@ class Preprocessor(c_ast.NodeVisitor):
     def visit_FileAST(self, node: c_ast.FileAST) -> c_ast.FuncDef:
         """Top level ast node"""
         # first get all FuncDef nodes
-        function_nodes = tuple(filter(lambda child: isinstance(child, c_ast.FuncDef), node))
+        function_nodes = [child for child in node.ext if isinstance(child, c_ast.FuncDef)]
 
         if self._target_function:
             # if target function is specified, check if it exists
-            target_function = next(filter(lambda child: child.decl.name == self._target_function, function_nodes))
+            target_function = next(
+                (function for function in function_nodes if function.decl.name == self._target_function), None)
             if not target_function:
                 raise ValueError(f'Target function {self._target_function} not found in the source file')
         else:
@@ -133,9 +157,12 @@ class Preprocessor(c_ast.NodeVisitor):
         for name, (aligned, shadow) in types.items():
             self._type_system.update_distance(name, aligned, shadow)
 
-        # remove the annotation nodes
-        copied = deepcopy(node)
-        copied.body.block_items = node.body.block_items[3:]
+        # remove the annotation nodes, only the remaining statements are copied since they are modified afterwards
+        # (the declaration types and the noise scales), the function declaration is shared as the parameters are
+        # already processed in place
+        copied = copy(node)
+        copied.body = c_ast.Compound(block_items=[clone(item) for item in node.body.block_items[3:]],
+                                     coord=node.body.coord)
         self.generic_visit(copied.body)
         return copied
 
@@ -148,12 +175,12 @@ class Preprocessor(c_ast.NodeVisitor):
         # check if variable type is supported and then update the type in type system
         if isinstance(node.type, (c_ast.TypeDecl, c_ast.ArrayDecl)):
             is_array = isinstance(node.type, c_ast.ArrayDecl)
-            type_node = node.type.type.type if isinstance(node.type, c_ast.ArrayDecl) else node.type.type
+            type_node = node.type.type.type if is_array else node.type.type
             # only support primitive types
             if len(type_node.names) != 1:
                 raise NotImplementedError(
                     f"Type {' '.join(type_node.names)} for variable {node.name} currently not supported.")
-            if type_node.names[0] != 'int':
+            if type_node.names[0] not in _SUPPORTED_TYPES:
                 logger.warning(f'Changing \'{generate(node)}\' to int declaration'
                                f' due to limitations of our symbolic executor KLEE. This may bring imprecision.')
                 type_node.names[0] = 'int'
@@ -183,8 +210,12 @@ class Preprocessor(c_ast.NodeVisitor):
             raise TypeError('node must be of type Union(FileAST, FuncDef)')
         processed = self.visit(node)
         # scale up the random noise scales due to limitations of symbolic executor KLEE only supporting integers
-        all_scales = [f'1 / ({generate(func_call.args.exprs[0])})' for func_call in self._random_scales]
-        lcm = sp.lcm(tuple(map(lambda scale: sp.fraction(scale)[1], all_scales + [self._goal])))
+        # the same scales are often used by multiple random variables, only the distinct ones are passed to sympy
+        all_scales = dict.fromkeys(f'1 / ({generate(func_call.args.exprs[0])})' for func_call in self._random_scales)
+        # avoid the expensive sympy calls for the integer scales
+        lcm = _integer_lcm(all_scales, self._goal)
+        if lcm is None:
+            lcm = sp.lcm(tuple(map(lambda scale: sp.fraction(scale)[1], (*all_scales, self._goal))))
         # TODO: use less hackery method to tackle the Pow operation in sympy
         # see also https://stackoverflow.com/questions/14264431/expanding-algebraic-powers-in-python-sympy
         if str(lcm) != '1':
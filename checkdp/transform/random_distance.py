@@ -1,12 +1,12 @@
-from typing import Dict, Set, Tuple, Sequence, List, Optional
+from typing import Dict, Set, Tuple, Sequence, List, Optional, FrozenSet
 from enum import Enum
 import logging
-from queue import Queue
+from collections import deque
 import pycparser.c_ast as c_ast
 import checkdp.transform.constants as constants
 from checkdp.transform.utils import NodeFinder, ExprType, VariableType, generate
 from checkdp.transform.typesystem import TypeSystem
-from checkdp.transform.utils import DistanceGenerator, parse
+from checkdp.transform.utils import DistanceGenerator, parse_expr
 
 
 logger = logging.getLogger(__name__)
@@ -19,59 +19,80 @@ class AlignmentIndexType(Enum):
 
 
 def _generate_random_distance(conditions: Sequence[str], variables: Sequence[str],
-                              alignment_array_types: List[AlignmentIndexType], is_selector=False) -> str:
-    start_index = len(alignment_array_types)
-    if len(conditions) == 0:
-        template_parts = [f'{constants.ALIGNMENT_ARRAY}[{start_index}]']
-        if is_selector:
-            alignment_array_types.append(AlignmentIndexType.Selector)
+                              alignment_array_types: List[AlignmentIndexType], is_selector=False,
+                              share_leaves=False) -> str:
+    """generate the template, i.e., a full tree of ternary operators on the conditions whose leaves are linear
+    combinations of the variables, each leaf uses its own (consecutive) indices of the alignment array. If
+    share_leaves is specified, all the leaves share the same indices, i.e., the conditions are dropped and the
+    template is a single leaf, which shrinks the search space but can only find branch-independent alignments."""
+    # the template is generated in order as a list of parts and joined at last, instead of concatenating the nested
+    # ternary operators level by level, e.g., the template for conditions (c0, c1) is
+    # c0 ? c1 ? leaf_0 : leaf_1 : c1 ? leaf_2 : leaf_3
+    parts = []
+    leaf_type = AlignmentIndexType.Selector if is_selector else AlignmentIndexType.Constant
+    depth = 0 if share_leaves else len(conditions)
+    for leaf_index in range(2 ** depth):
+        if leaf_index == 0:
+            opened = 0
         else:
-            alignment_array_types.append(AlignmentIndexType.Constant)
+            # the leaf is the right child of the condition at the level of the lowest set bit of its index, and the
+            # left-most leaf of the conditions below that level
+            opened = depth - (leaf_index & -leaf_index).bit_length() + 1
+            parts.append(' : ')
+        parts.extend(f'{condition} ? ' for condition in conditions[opened:depth])
+
+        start_index = len(alignment_array_types)
+        template_parts = [f'{constants.ALIGNMENT_ARRAY}[{start_index}]']
+        alignment_array_types.append(leaf_type)
         for index, variable in enumerate(variables):
             template_parts.append(f'{constants.ALIGNMENT_ARRAY}[{start_index + 1 + index}] * {variable}')
             alignment_array_types.append(AlignmentIndexType.Variable)
-
-        return '(' + ' + '.join(template_parts) + ')'
-    left = _generate_random_distance(conditions[1:], variables, alignment_array_types, is_selector)
-    right = _generate_random_distance(conditions[1:], variables, alignment_array_types, is_selector)
-    return f'{conditions[0]} ? {left} : {right}'
+        parts.append('(' + ' + '.join(template_parts) + ')')
+    return ''.join(parts)
 
 
 class RandomDistanceGenerator(c_ast.NodeVisitor):
-    def __init__(self, type_system: TypeSystem, enable_shadow: bool = False):
+    def __init__(self, type_system: TypeSystem, enable_shadow: bool = False, share_alignments: bool = False):
         self._type_system = type_system
-        # keep a dictionary from variable name -> set of variable names it depends on
-        self._depends: Dict[str, Set[VariableType]] = {}
+        # keep a dictionary from variable name -> variables it depends on, keyed by their generated code, so that the
+        # dependency graph can be traversed without generating the code again
+        self._depends: Dict[str, Dict[str, VariableType]] = {}
         # the live variable dictionary, random variable -> live variable set, this is used to remove some variables
         # in the final template generation
-        self._live_variable: Dict[str, Set[str]] = {}
+        self._live_variable: Dict[str, FrozenSet[str]] = {}
+        # the frozen set of the variable names in self._depends, shared by the live variable sets of the random
+        # variables until a variable is added or removed
+        self._live_names: Optional[FrozenSet[str]] = None
         # the template for each random variable, random variable -> (condition set, dependent variable set)
         # this is used to generate the final template
         self._templates: Dict[str, Tuple[Set[str], Set[str]]] = {}
         self._random_variables: Set[str] = set()
         self._visited_assertions: Set[c_ast.FuncCall] = set()
         self._enable_shadow = enable_shadow
-
-    def _all_depends(self, expression: ExprType):
-        dependencies = set()
-        visited = set()
-        to_visit: Queue = Queue()
-
-        for node in NodeFinder(lambda n: isinstance(n, (c_ast.ID, c_ast.ArrayRef))).visit(expression):
-            if constants.PREFIX not in generate(node):
-                to_visit.put(node)
-
-        while not to_visit.empty():
-            visit_node = to_visit.get()
-            if visit_node not in visited:
-                visited.add(visit_node)
-                dependencies.add(visit_node)
-
+        # whether the branches share the same alignment, see _generate_random_distance
+        self._share_alignments = share_alignments
+        # the finders are shared by all visits
+        self._variable_finder = NodeFinder(lambda n: isinstance(n, (c_ast.ID, c_ast.ArrayRef)))
+        self._id_finder = NodeFinder(lambda n: isinstance(n, c_ast.ID))
+
+    def _all_depends(self, expression: ExprType) -> Dict[str, VariableType]:
+        """return the variables the expression (transitively) depends on, keyed by their generated code, the references
+        to the same variable (e.g., multiple occurrences of x) are only visited once"""
+        dependencies: Dict[str, VariableType] = {}
+        to_visit: deque = deque()
+
+        for node in self._variable_finder.visit(expression):
+            name = generate(node)
+            if constants.PREFIX not in name:
+                to_visit.append((name, node))
+
+        while to_visit:
+            name, visit_node = to_visit.popleft()
+            if name not in dependencies:
+                dependencies[name] = visit_node
                 # add its dependencies to to_visit queue
-                name = generate(visit_node)
                 if name in self._depends:
-                    for visit_dependent in self._depends[name]:
-                        to_visit.put(visit_dependent)
+                    to_visit.extend(self._depends[name].items())
 
         return dependencies
 
@@ -84,52 +105,76 @@ class RandomDistanceGenerator(c_ast.NodeVisitor):
             # create empty set for this random variable
             self._templates[left] = (set(), set())
             # create the live variable set for this random variable
-            self._depends[left] = set()
-            self._live_variable[left] = set(self._depends.keys())
+            self._set_depends(left, {})
+            if self._live_names is None:
+                self._live_names = frozenset(self._depends)
+            self._live_variable[left] = self._live_names
             self._random_variables.add(left)
             return
 
-        finder = NodeFinder(lambda n: isinstance(n, (c_ast.ID, c_ast.ArrayRef)))
-        self._depends[left] = set(n for n in finder.visit(right))
+        self._set_depends(left, {generate(n): n for n in self._variable_finder.visit(right)})
+
+    def _set_depends(self, name: str, dependencies: Dict[str, VariableType]):
+        if name not in self._depends:
+            self._live_names = None
+        self._depends[name] = dependencies
 
     def _add_dependencies(self, expression: ExprType, if_cond: Optional[ExprType]):
         dependencies = self._all_depends(expression)
+        # the generated code of the condition does not depend on the random variables, therefore it is only generated
+        # once
+        generated_condition = generate(if_cond) if if_cond else None
+        # the variables referenced by each dependency are collected once, a dependency is alive at the line of the
+        # random variable generation if all of them are alive
+        dependency_ids = {name: tuple(n.name for n in self._id_finder.visit(dependency))
+                          for name, dependency in dependencies.items()}
+        # whether the variables (keyed by their generated code) are eligible for the V sets apart from the liveness
+        is_candidate: Dict[str, bool] = {}
+        # the random variables often share the same live variable set (e.g., sampled in the same block), therefore
+        # the liveness of the dependencies is computed once per live variable set
+        liveness: Dict[FrozenSet[str], Dict[str, bool]] = {}
         for eta in self._templates.keys():
-            liveness_checker = NodeFinder(
-                lambda n: (isinstance(n, c_ast.ID) and n.name in self._live_variable[eta])
-            )
-            id_count_checker = NodeFinder(lambda n: isinstance(n, c_ast.ID))
+            live_variables = self._live_variable[eta]
+            alive = liveness.setdefault(live_variables, {})
+
+            def is_alive(dependency: str) -> bool:
+                if dependency not in alive:
+                    alive[dependency] = all(name in live_variables for name in dependency_ids[dependency])
+                return alive[dependency]
 
-            dependency_strings = tuple(map(lambda n: generate(n), dependencies))
             # add to E and V set if it is generated if the assertion depends on the random variable
-            if eta in dependency_strings:
+            if eta in dependencies:
                 # add to E set if it is generated by if command and the dependencies are alive
-                if if_cond and all(len(liveness_checker.visit(dependency)) == len(id_count_checker.visit(dependency))
-                                   for dependency in dependencies):
-                    self._templates[eta][0].add(generate(if_cond))
+                if if_cond and all(is_alive(dependency) for dependency in dependencies):
+                    self._templates[eta][0].add(generated_condition)
 
                 # add variable to V set, only if the dependency is alive at the line of random variable generation
-                for variable_node in dependencies:
-                    variable_name = \
-                        variable_node.name if isinstance(variable_node, c_ast.ID) else variable_node.name.name
+                for generated_variable, variable_node in dependencies.items():
                     # the variable must be alive
-                    if len(liveness_checker.visit(variable_node)) != len(id_count_checker.visit(variable_node)):
-                        continue
-
-                    # it cannot be a random variable
-                    if variable_node.name in self._random_variables:
-                        continue
-
-                    # ignore plain reference to array variable, i.e., without subscript
-                    # this means the assertion depends on the array, but no specific index is given, therefore
-                    # should not be generated in the template
-                    _, _, _, is_array = self._type_system.get_types(variable_name)
-                    if is_array and isinstance(variable_node, c_ast.ID):
+                    if not is_alive(generated_variable):
                         continue
-                    # the variable must be dynamically-tracked
-                    aligned_distance = self._type_system.get_types(variable_name)[0]
-                    if aligned_distance == '*' or constants.ALIGNED_DISTANCE in aligned_distance:
-                        self._templates[eta][1].add(generate(variable_node))
+                    # the other requirements do not depend on the random variable, therefore they are only checked
+                    # once for each variable
+                    if generated_variable not in is_candidate:
+                        is_candidate[generated_variable] = self._is_template_variable(variable_node)
+                    if is_candidate[generated_variable]:
+                        self._templates[eta][1].add(generated_variable)
+
+    def _is_template_variable(self, variable_node: VariableType) -> bool:
+        """check if the (alive) variable should be added to the V set"""
+        variable_name = variable_node.name if isinstance(variable_node, c_ast.ID) else variable_node.name.name
+        # it cannot be a random variable
+        if variable_node.name in self._random_variables:
+            return False
+
+        # ignore plain reference to array variable, i.e., without subscript
+        # this means the assertion depends on the array, but no specific index is given, therefore
+        # should not be generated in the template
+        aligned_distance, _, _, is_array = self._type_system.get_types(variable_name)
+        if is_array and isinstance(variable_node, c_ast.ID):
+            return False
+        # the variable must be dynamically-tracked
+        return aligned_distance == '*' or constants.ALIGNED_DISTANCE in aligned_distance
 
     def visit_Assignment(self, node: c_ast.Assignment):
         self._assignment(node.lvalue.name, node.rvalue)
@@ -147,8 +192,7 @@ class RandomDistanceGenerator(c_ast.NodeVisitor):
 
     def visit_If(self, node: c_ast.If):
         # ignore generated shadow branch
-        finder = NodeFinder(lambda n: isinstance(n, c_ast.ID))
-        if any(constants.PREFIX in n.name for n in finder.visit(node.cond)):
+        if any(constants.PREFIX in n.name for n in self._id_finder.iterate(node.cond)):
             logger.debug(f'Ignored shadow branch if ({generate(node.cond)})')
             return
 
@@ -170,10 +214,10 @@ class RandomDistanceGenerator(c_ast.NodeVisitor):
         # for scope check
         self.generic_visit(node)
         # remove the variables
-        all_variables_visitor = NodeFinder(lambda n: isinstance(n, c_ast.ID))
-        for variable in all_variables_visitor.visit(node.cond):
+        for variable in self._id_finder.visit(node.cond):
             if variable.name in self._depends:
                 del self._depends[variable.name]
+                self._live_names = None
 
     def generate(self, node: c_ast.FuncDef) -> Dict[str, Tuple[Set[str], Set[str]]]:
         """Generate raw condition set (E set) and variable set (V set)"""
@@ -191,17 +235,19 @@ class RandomDistanceGenerator(c_ast.NodeVisitor):
         distance_generator = DistanceGenerator(self._type_system)
         inserted, alignment_array_types = [], []
         for random_variable, (conditions, variables) in self._templates.items():
-            distance_variables = (distance_generator.visit(parse(variable))[0] for variable in variables)
+            distance_variables = (distance_generator.visit(parse_expr(variable))[0] for variable in variables)
             if self._enable_shadow:
                 # generate template for selectors
                 if len(conditions) == 0:
                     template = constants.SELECT_ALIGNED
                 else:
-                    template = _generate_random_distance(tuple(conditions), tuple(), alignment_array_types, is_selector=True)
+                    template = _generate_random_distance(tuple(conditions), tuple(), alignment_array_types,
+                                                         is_selector=True, share_leaves=self._share_alignments)
                 logger.debug(f'Generated selector template for {random_variable}: {template}')
                 inserted.append(f'#define {constants.SELECTOR}_{random_variable} ({template})')
             # convert the sets to tuples since our naive recursive implementation requires orders
-            template = _generate_random_distance(tuple(conditions), tuple(distance_variables), alignment_array_types)
+            template = _generate_random_distance(tuple(conditions), tuple(distance_variables), alignment_array_types,
+                                                 share_leaves=self._share_alignments)
             logger.debug(f'Generated alignment template for {random_variable}: {template}')
             inserted.append(f'#define {constants.RANDOM_DISTANCE}_{random_variable} ({template})')
 
@@ -1,4 +1,5 @@
-from typing import Dict, Union, Iterable, Callable, Sequence, List
+from typing import Dict, Union, Iterable, Callable, Sequence, List, Optional, TextIO
+import functools
 import itertools
 import re
 import sympy as sp
@@ -6,9 +7,14 @@ import pycparser.c_ast as c_ast
 import checkdp.transform.constants as constants
 from checkdp.transform.typesystem import TypeSystem
 from checkdp.transform.random_distance import AlignmentIndexType
-from checkdp.transform.utils import generate, parse
+from checkdp.transform.utils import generate, parse_expr, clone
 
 _Number = Union[int, float]
+# the statement to make a variable symbolic, the pointer is the variable itself for arrays and its address otherwise
+_MAKE_SYMBOLIC = 'klee_make_symbolic({pointer}, sizeof({variable}), "{variable}");'
+_SYMBOLIC_COST_STATEMENT = _MAKE_SYMBOLIC.format(pointer=constants.SYMBOLIC_COST, variable=constants.SYMBOLIC_COST)
+_SYMBOLIC_INDEX_STATEMENT = _MAKE_SYMBOLIC.format(pointer=f'&{constants.PREFIX}_index',
+                                                  variable=f'{constants.PREFIX}_index')
 
 
 _HEADER = f"""#include <stdio.h>
@@ -35,22 +41,140 @@ _HEADER = f"""#include <stdio.h>
 """
 
 
-def _simplify_node(node: c_ast.Node):
-    def translate(expression: str, encode):
-        transcodes = {
-            '[': '__LEFTBRACE__',
-            ']': '__RIGHTBRACE__'
-        }
-        for k, v in transcodes.items():
-            expression = expression.replace(k, v) if encode else expression.replace(v, k)
-        return expression
+# the macros of the random distances / selectors and the alignment array accesses in them
+_RANDOM_DISTANCE_DEFINE_RE = re.compile(rf'#define\s+{constants.RANDOM_DISTANCE}_([a-zA-Z_][a-zA-Z0-9_]+)\s+(.*)')
+_SELECTOR_DEFINE_RE = re.compile(rf'#define\s+{constants.SELECTOR}_([a-zA-Z_][a-zA-Z0-9_]+)\s+(.*)')
+_ALIGNMENT_RE = re.compile(rf'{re.escape(constants.ALIGNMENT_ARRAY)}\[(\d+)\]')
+
+
+# the assumptions on the query variable and its aligned distance for each sensitivity precondition, the C braces
+# are escaped for str.format
+_QUERY_ASSUMPTION_TEMPLATES: Dict[str, str] = {
+    constants.ALL_DIFFER:
+        'for(int i = 0; i < {query_size}; i ++){{\n'
+        '  {ASSUME}({ALIGNED_DISTANCE}_{query}[i] >= -1);\n'
+        '  {ASSUME}({ALIGNED_DISTANCE}_{query}[i] <= 1);\n'
+        '  {ASSUME}({query}[i] >= -10);\n'
+        '  {ASSUME}({query}[i] <= 10);\n'
+        '  klee_prefer_cex({ALIGNED_DISTANCE}_{query}, {ALIGNED_DISTANCE}_{query}[i] != 0);\n'
+        '}}\n',
+    constants.ONE_DIFFER:
+        '{ASSUME}({PREFIX}_index >= 0);\n'
+        '{ASSUME}({PREFIX}_index < {query_size});\n'
+        'for(int i = 0; i < {query_size}; i ++){{\n'
+        '  {ASSUME}({query}[i] >= -10);\n'
+        '  {ASSUME}({query}[i] <= 10);\n'
+        '  if({PREFIX}_index == i) {{\n'
+        '    {ASSUME}({ALIGNED_DISTANCE}_{query}[i] >= -1);\n'
+        '    {ASSUME}({ALIGNED_DISTANCE}_{query}[i] <= 1);\n'
+        '    klee_prefer_cex({ALIGNED_DISTANCE}_{query}, {ALIGNED_DISTANCE}_{query}[i] != 0);\n'
+        '  }} else {{\n'
+        '    {ASSUME}({ALIGNED_DISTANCE}_{query}[i] == 0);\n'
+        '  }}\n'
+        '}}\n',
+    constants.DECREASING:
+        'for(int i = 0; i < {query_size}; i ++){{\n'
+        '  {ASSUME}({ALIGNED_DISTANCE}_{query}[i] >= -1);\n'
+        '  {ASSUME}({ALIGNED_DISTANCE}_{query}[i] <= 0);\n'
+        '  {ASSUME}({query}[i] >= -10);\n'
+        '  {ASSUME}({query}[i] <= 10);\n'
+        '  klee_prefer_cex({ALIGNED_DISTANCE}_{query}, {ALIGNED_DISTANCE}_{query}[i] != 0);\n'
+        '}}\n',
+    constants.INCREASING:
+        'for(int i = 0; i < {query_size}; i ++){{\n'
+        '  {ASSUME}({ALIGNED_DISTANCE}_{query}[i] >= 0);\n'
+        '  {ASSUME}({ALIGNED_DISTANCE}_{query}[i] <= 1);\n'
+        '  {ASSUME}({query}[i] >= -10);\n'
+        '  {ASSUME}({query}[i] <= 10);\n'
+        '  klee_prefer_cex({ALIGNED_DISTANCE}_{query}, {ALIGNED_DISTANCE}_{query}[i] != 0);\n'
+        '}}\n',
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _query_assumption(query_assumption: str, query: str, query_size: int) -> str:
+    """render the assumptions for the query variable, the results are cached since the fills of the same template
+    share the same query and (usually) the same query size"""
+    if query_assumption not in _QUERY_ASSUMPTION_TEMPLATES:
+        raise NotImplementedError(f'Query assumption {query_assumption} not yet supported.')
+    return _QUERY_ASSUMPTION_TEMPLATES[query_assumption].format(
+        query=query, query_size=query_size, ASSUME=constants.ASSUME, ALIGNED_DISTANCE=constants.ALIGNED_DISTANCE,
+        PREFIX=constants.PREFIX)
+
+
+@functools.lru_cache(maxsize=1024)
+def _array_initializer(variable: str, values: Sequence[str]) -> str:
+    """return the statements initializing the array variable with the values on a single line, the results are cached
+    since the same arrays (e.g., the alignments or the inputs) recur across the concretes and fills"""
+    return ' '.join(f'{variable}[{index}] = {value};' for index, value in enumerate(values))
+
+
+def _substitute_alignments(expression: str, values: Sequence[str]) -> str:
+    """replace the alignment array accesses with the given values in a single pass, the out-of-range accesses are
+    left untouched"""
+    def substitute(match):
+        index = int(match.group(1))
+        return values[index] if index < len(values) else match.group(0)
+    return _ALIGNMENT_RE.sub(substitute, expression)
+
+
+# sympy cannot parse the brackets of the array accesses, therefore they are encoded as parts of the identifiers
+_BRACKET_ENCODINGS = {'[': '__LEFTBRACE__', ']': '__RIGHTBRACE__'}
+_BRACKET_ENCODE_TABLE = str.maketrans(_BRACKET_ENCODINGS)
+_BRACKET_DECODINGS = {encoded: original for original, encoded in _BRACKET_ENCODINGS.items()}
+_BRACKET_DECODE_RE = re.compile('|'.join(_BRACKET_DECODINGS))
+
+
+def _is_linear(expression: sp.Expr) -> bool:
+    """check if the (automatically evaluated) expression is an integer linear combination of the symbols, which is
+    already in its simplest form"""
+    terms = expression.args if expression.is_Add else (expression, )
+    for term in terms:
+        if term.is_Mul:
+            if len(term.args) != 2 or not (term.args[0].is_Integer and term.args[1].is_Symbol):
+                return False
+        elif not (term.is_Integer or term.is_Symbol):
+            return False
+    return True
+
+
+@functools.lru_cache(maxsize=8192)
+def _simplify_expression(expression: str) -> str:
+    """simplify the expression with sympy, the brackets of the array accesses are encoded since sympy cannot parse
+    them, the results are cached since sympy's simplify is expensive and the same expressions recur"""
+    expression = expression.translate(_BRACKET_ENCODE_TABLE)
+    # the alignments are mostly linear combinations of the variables once the alignment array is concrete, sympy's
+    # automatic evaluation already collects their terms (e.g., eliminating those with coefficient 0), the expensive
+    # simplify is only needed for the other expressions
+    parsed = sp.sympify(expression)
+    expression = str(parsed if _is_linear(parsed) else sp.simplify(parsed))
+    return _BRACKET_DECODE_RE.sub(lambda match: _BRACKET_DECODINGS[match.group(0)], expression)
+
 
+def _simplify_node(node: c_ast.Node):
     if isinstance(node, c_ast.TernaryOp):
         return f'({generate(node.cond)}) ? ({_simplify_node(node.iftrue)}) : ({_simplify_node(node.iffalse)})'
     elif isinstance(node, c_ast.BinaryOp) and node.op in ('&&', '||'):
         return f'({_simplify_node(node.left)}) {node.op} ({_simplify_node(node.right)})'
     else:
-        return translate(str(sp.simplify(translate(generate(node), encode=True))), encode=False)
+        return _simplify_expression(generate(node))
+
+
+class _FunctionRewriter(c_ast.NodeVisitor):
+    """rewrite the transformed function in place for the driver, i.e., changes the float types to int and the shadow
+    distance of the query variable to its aligned distance"""
+    def __init__(self, query: str):
+        self._shadow_distance = f'{constants.SHADOW_DISTANCE}_{query}'
+        self._aligned_distance = f'{constants.ALIGNED_DISTANCE}_{query}'
+
+    def visit_IdentifierType(self, node: c_ast.IdentifierType):
+        # TODO: temporarily replace all floats with ints
+        node.names = ['int' if name == 'float' else name for name in node.names]
+
+    def visit_ID(self, node: c_ast.ID):
+        # TODO: temporarily replace CHECKDP_SHADOW_DISTANCE_q with CHECKDP_ALIGNED_DISTANCE_q
+        if node.name == self._shadow_distance:
+            node.name = self._aligned_distance
 
 
 class Template:
@@ -64,13 +188,67 @@ class Template:
         self._type_system = type_system
         self._function = function
         self._parameters = tuple(decl.name for decl in function.decl.type.args.params)
+        # the parameter declarations are fixed for the template, therefore they are classified once
+        self._parameter_declarations = tuple(function.decl.type.args.params)
+        other_parameters = self._parameter_declarations[3:]
+        self._user_parameters = \
+            tuple(param for param in other_parameters if not param.name.startswith(constants.PREFIX))
+        self._added_parameters = tuple(param for param in other_parameters if param.name.startswith(constants.PREFIX))
         self._random_distances = random_distances
         self._goal = goal
+        # the header only depends on the goal, therefore it is rendered once for all fills
+        self._header = _HEADER.replace('PENALTY', goal)
         self._alignment_array_types = alignment_array_types
         self._sample_array_size_func = sample_array_size_func
         self._preconditions = preconditions
         self._holes = holes
         self._hole_preconditions = hole_preconditions
+        # the user-defined assumptions split around the size variable, which is replaced by the query size in fill
+        # TODO: use regex for better robustness
+        _, *user_assumptions = preconditions
+        self._user_assumption_parts = tuple(
+            (f'{constants.ASSUME}(', *assumption.split(self._parameters[1]), ');') for assumption in user_assumptions)
+        # the statements to make each parameter symbolic when it is not given in the concretes, the parameters are
+        # classified once here instead of in every fill
+        self._symbolic_parameters = self._classify_parameters()
+        # the function does not change between fills, therefore it is rewritten (on a copy) and generated only once
+        rewritten = clone(function)
+        _FunctionRewriter(self._parameters[0]).visit(rewritten)
+        self._function_source = generate(rewritten)
+        # the macros of the random distances and selectors (random variable -> template), extracted once for all the
+        # reported alignments
+        self._random_distance_defines = {match.group(1): match.group(2)
+                                         for match in _RANDOM_DISTANCE_DEFINE_RE.finditer(random_distances)}
+        self._selector_defines = {match.group(1): match.group(2)
+                                  for match in _SELECTOR_DEFINE_RE.finditer(random_distances)}
+
+    def _classify_parameters(self) -> Dict[str, Optional[str]]:
+        """return the klee_make_symbolic statement for each parameter in order, epsilon and size parameters are
+        excluded since they are always concrete, None is given for the unsupported parameters"""
+        query, size, epsilon, *_ = self._parameters
+        statements: Dict[str, Optional[str]] = {}
+        for variable in self._parameters:
+            # the name passed to klee, which is the variable itself except for the sample array
+            name = variable
+            if variable == constants.ALIGNMENT_ARRAY:
+                pointer = constants.ALIGNMENT_ARRAY
+            elif variable == epsilon or variable == size:
+                # epsilon is pre-specified as 1 and size variable is controlled by query_size
+                continue
+            elif constants.ALIGNED_DISTANCE in variable:
+                if variable != f'{constants.ALIGNED_DISTANCE}_{query}':
+                    statements[variable] = None
+                    continue
+                pointer = variable
+            elif constants.SAMPLE_ARRAY in variable:
+                name = pointer = constants.SAMPLE_ARRAY
+            elif constants.HOLE in variable:
+                pointer = f'&{variable}'
+            else:
+                _, _, _, is_array = self._type_system.get_types(variable)
+                pointer = variable if is_array else f'&{variable}'
+            statements[variable] = _MAKE_SYMBOLIC.format(pointer=pointer, variable=name)
+        return statements
 
     def __str__(self):
         # give an empty alignment for debugging purposes
@@ -88,32 +266,26 @@ class Template:
     def random_distance(self, alignments_values):
         alignments_values = alignments_values[-1][constants.ALIGNMENT_ARRAY]
         alignments = {}
-        for match in re.finditer(f'#define\\s+{constants.RANDOM_DISTANCE}_([a-zA-Z_][a-zA-Z0-9_]+)\\s+(.*)',
-                                 self._random_distances):
-            alignment = match.group(2)
-            for index, value in enumerate(alignments_values):
-                alignment = alignment.replace(f'{constants.ALIGNMENT_ARRAY}[{index}]', str(value))
+        values = tuple(str(value) for value in alignments_values)
+        for random_variable, template in self._random_distance_defines.items():
+            alignment = _substitute_alignments(template, values)
             # try to simplify the expression (mostly eliminating the terms with coefficient 0)
             try:
-                alignment = _simplify_node(parse(alignment))
+                alignment = _simplify_node(parse_expr(alignment))
             finally:
-                alignments[match.group(1)] = alignment
+                alignments[random_variable] = alignment
         return alignments
 
     def selector(self, alignments_values):
         alignments_values = alignments_values[-1][constants.ALIGNMENT_ARRAY]
         alignments = {}
-        for match in re.finditer(f'#define\\s+{constants.SELECTOR}_([a-zA-Z_][a-zA-Z0-9_]+)\\s+(.*)',
-                                 self._random_distances):
-            alignment = match.group(2)
-            for index, value in enumerate(alignments_values):
-                value = 'ALIGNED' if str(value) == constants.SELECT_ALIGNED else 'SHADOW'
-                alignment = alignment.replace(f'{constants.ALIGNMENT_ARRAY}[{index}]', str(value))
-            alignments[match.group(1)] = alignment
+        values = tuple('ALIGNED' if str(value) == constants.SELECT_ALIGNED else 'SHADOW' for value in alignments_values)
+        for random_variable, template in self._selector_defines.items():
+            alignments[random_variable] = _substitute_alignments(template, values)
         return alignments
 
     def related_inputs(self, original_inputs: Dict[str, Union[_Number, Sequence[_Number]]]):
-        query_variable = self._function.decl.type.args.params[0].name
+        query_variable = self._parameters[0]
         related = original_inputs.copy()
         related[query_variable] = [x + y for x, y in zip(related[query_variable],
                                                          related[f'{constants.ALIGNED_DISTANCE}_{query_variable}'])]
@@ -122,15 +294,23 @@ class Template:
     def fill(self, concretes: Sequence[Dict[str, Union[_Number, Sequence[_Number]]]], query_size: int,
              add_symbolic_cost: bool = True):
         """Generate driver code (main function) and return the whole transformed program"""
+        return ''.join(self._fill_pieces(concretes, query_size, add_symbolic_cost))
+
+    def fill_to(self, file_obj: TextIO, concretes: Sequence[Dict[str, Union[_Number, Sequence[_Number]]]],
+                query_size: int, add_symbolic_cost: bool = True):
+        """Same as fill, but write the whole transformed program directly to an opened file without building the
+        full string in memory"""
+        file_obj.writelines(self._fill_pieces(concretes, query_size, add_symbolic_cost))
+
+    def _fill_pieces(self, concretes: Sequence[Dict[str, Union[_Number, Sequence[_Number]]]], query_size: int,
+                     add_symbolic_cost: bool) -> Iterable[str]:
         if len(concretes) == 0 or len(concretes[0]) == 0:
             raise NotImplementedError('At least one concrete must be provided to start the process')
         # TODO: add sanity checks for parameter concretes
 
         sample_array_size = self._sample_array_size_func(query_size)
-        query_node, size_node, epsilon_node, *other_parameters = (decl for decl in self._function.decl.type.args.params)
-        user_parameters = [param for param in other_parameters if not param.name.startswith(constants.PREFIX)]
-        added_parameters = [param for param in other_parameters if param.name.startswith(constants.PREFIX)]
-        query_assumption, *user_assumptions = self._preconditions
+        query_node, size_node, epsilon_node, *_ = self._parameter_declarations
+        query_assumption, *_ = self._preconditions
 
         # add declarations of all the variables
         query = query_node.name
@@ -139,12 +319,12 @@ class Template:
             f'int {query}[{query_size}];',
             f'int {epsilon_node.name} = 1;',
             *(f'int {param.name};' if isinstance(param.type, c_ast.TypeDecl) else f'int {param.name}[{query_size}];'
-              for param in user_parameters),
+              for param in self._user_parameters),
             # for symbolic cost variables
             f'int {constants.SYMBOLIC_COST}[{len(concretes)}];'
         ]
 
-        for param in added_parameters:
+        for param in self._added_parameters:
             if param.name.startswith(constants.ALIGNED_DISTANCE) or param.name.startswith(constants.SHADOW_DISTANCE):
                 declarations.append(f'int {param.name}[{query_size}];')
             elif param.name.startswith(constants.SAMPLE_ARRAY):
@@ -186,54 +366,7 @@ class Template:
                 )
             operator = '<='
         if has_alignments and not has_inputs:
-            if query_assumption == constants.ALL_DIFFER:
-                assumptions.append(
-                    f'for(int i = 0; i < {query_size}; i ++)' '{\n'
-                    f'  {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] >= -1);\n'
-                    f'  {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] <= 1);\n'
-                    f'  {constants.ASSUME}({query}[i] >= -10);\n'
-                    f'  {constants.ASSUME}({query}[i] <= 10);\n'
-                    f'  klee_prefer_cex({constants.ALIGNED_DISTANCE}_{query}, {constants.ALIGNED_DISTANCE}_{query}[i] != 0);\n'
-                    '}\n'
-                )
-            elif query_assumption == constants.ONE_DIFFER:
-                assumptions.append(
-                    f'{constants.ASSUME}({constants.PREFIX}_index >= 0);\n'
-                    f'{constants.ASSUME}({constants.PREFIX}_index < {query_size});\n'
-                    f'for(int i = 0; i < {query_size}; i ++)' '{\n'
-                    f'  {constants.ASSUME}({query}[i] >= -10);\n'
-                    f'  {constants.ASSUME}({query}[i] <= 10);\n'
-                    f'  if({constants.PREFIX}_index == i) ' '{\n'
-                    f'    {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] >= -1);\n'
-                    f'    {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] <= 1);\n'
-                    f'    klee_prefer_cex({constants.ALIGNED_DISTANCE}_{query}, {constants.ALIGNED_DISTANCE}_{query}[i] != 0);\n'
-                    '  } else {\n'
-                    f'    {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] == 0);\n'
-                    '  }\n'
-                    '}\n'
-                )
-            elif query_assumption == constants.DECREASING:
-                assumptions.append(
-                    f'for(int i = 0; i < {query_size}; i ++)' '{\n'
-                    f'  {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] >= -1);\n'
-                    f'  {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] <= 0);\n'
-                    f'  {constants.ASSUME}({query}[i] >= -10);\n'
-                    f'  {constants.ASSUME}({query}[i] <= 10);\n'
-                    f'  klee_prefer_cex({constants.ALIGNED_DISTANCE}_{query}, {constants.ALIGNED_DISTANCE}_{query}[i] != 0);\n'
-                    '}\n'
-                )
-            elif query_assumption == constants.INCREASING:
-                assumptions.append(
-                    f'for(int i = 0; i < {query_size}; i ++)' '{\n'
-                    f'  {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] >= 0);\n'
-                    f'  {constants.ASSUME}({constants.ALIGNED_DISTANCE}_{query}[i] <= 1);\n'
-                    f'  {constants.ASSUME}({query}[i] >= -10);\n'
-                    f'  {constants.ASSUME}({query}[i] <= 10);\n'
-                    f'  klee_prefer_cex({constants.ALIGNED_DISTANCE}_{query}, {constants.ALIGNED_DISTANCE}_{query}[i] != 0);\n'
-                    '}\n'
-                )
-            else:
-                raise NotImplementedError(f'Query assumption {query_assumption} not yet supported.')
+            assumptions.append(_query_assumption(query_assumption, query, query_size))
             # assumptions about the sample array
             assumptions.append(
                 f'for(int i = 0; i < {sample_array_size}; i++) ' '{\n'
@@ -242,87 +375,55 @@ class Template:
                 '}\n'
             )
             # user-defined assumptions
-            for assumption in user_assumptions:
-                if size_node.name in assumption:
-                    # TODO: use regex for better robustness
-                    assumptions.append(f'{constants.ASSUME}({assumption.replace(size_node.name, str(query_size))});')
-                else:
-                    assumptions.append(f'{constants.ASSUME}({assumption});')
+            size = str(query_size)
+            assumptions.extend(
+                prefix + size.join(parts) + suffix for prefix, *parts, suffix in self._user_assumption_parts)
             operator = '>'
 
         # create symbolic variables
         symbolic_statements = []
         if add_symbolic_cost:
-            symbolic_statements.append(
-                # first make the symbolic cost variables symbolic
-                f'klee_make_symbolic({constants.SYMBOLIC_COST}, sizeof({constants.SYMBOLIC_COST}), '
-                f'\"{constants.SYMBOLIC_COST}\");'
-            )
+            # first make the symbolic cost variables symbolic
+            symbolic_statements.append(_SYMBOLIC_COST_STATEMENT)
             
         if query_assumption == constants.ONE_DIFFER:
             declarations.append(f'int {constants.PREFIX}_index;')
             self._type_system.update_base_type(f'{constants.PREFIX}_index', 'int', False)
         if has_alignments and not has_inputs and query_assumption == constants.ONE_DIFFER:
-            symbolic_statements.append(
-                f'klee_make_symbolic(&{constants.PREFIX}_index, sizeof({constants.PREFIX}_index), '
-                f'\"{constants.PREFIX}_index\");'
-            )
-        for variable in {decl.name for decl in self._function.decl.type.args.params}.difference(concretes[0].keys()):
-            if variable == constants.ALIGNMENT_ARRAY:
-                symbolic_statements.append(
-                    f'klee_make_symbolic({constants.ALIGNMENT_ARRAY}, sizeof({constants.ALIGNMENT_ARRAY}), '
-                    f'\"{constants.ALIGNMENT_ARRAY}\");'
-                )
-            elif variable == epsilon_node.name or variable == size_node.name:
-                # epsilon is pre-specified as 1 and size variable is controlled by query_size
+            symbolic_statements.append(_SYMBOLIC_INDEX_STATEMENT)
+        for variable, statement in self._symbolic_parameters.items():
+            if variable in concretes[0]:
                 continue
-            elif constants.ALIGNED_DISTANCE in variable:
-                if variable != f'{constants.ALIGNED_DISTANCE}_{query_node.name}':
-                    raise NotImplementedError(f'Support for non-query arrays is not implemented yet: {variable}')
-                symbolic_statements.append(
-                    f'klee_make_symbolic({variable}, sizeof({variable}), \"{variable}\");'
-                )
-
-            elif constants.SAMPLE_ARRAY in variable:
-                symbolic_statements.append(
-                    f'klee_make_symbolic({constants.SAMPLE_ARRAY}, sizeof({constants.SAMPLE_ARRAY}), '
-                    f'\"{constants.SAMPLE_ARRAY}\");'
-                )
-            elif constants.HOLE in variable:
-                symbolic_statements.append(
-                    f'klee_make_symbolic(&{variable}, sizeof({variable}), \"{variable}\");'
-                )
-            else:
-                _, _, _, is_array = self._type_system.get_types(variable)
-                variable_pointer = f'{variable}' if is_array else f'&{variable}'
-                symbolic_statements.append(
-                    f'klee_make_symbolic({variable_pointer}, sizeof({variable}), \"{variable}\");'
-                )
+            if statement is None:
+                raise NotImplementedError(f'Support for non-query arrays is not implemented yet: {variable}')
+            symbolic_statements.append(statement)
 
         # create function calls
         parameter_list = ', '.join(decl.name if decl != size_node else str(query_size)
-                                   for decl in self._function.decl.type.args.params)
+                                   for decl in self._parameter_declarations)
         function_call = f"{self._function.decl.name}({parameter_list})"
         function_calls = []
+        # the indentations of the nested blocks of the function calls
+        indents = tuple('  ' * level for level in range(len(concretes) + 2))
         for initializer_index, initializer in enumerate(concretes):
             initialize_statements = []
             for variable, value in initializer.items():
                 if variable == constants.SYMBOLIC_COST:
                     continue
                 if isinstance(value, (tuple, list)):
-                    for index, item_value in enumerate(value):
-                        initialize_statements.append(f'{variable}[{index}] = {item_value};')
+                    if len(value) != 0:
+                        initialize_statements.append(_array_initializer(variable, tuple(map(str, value))))
                 else:
                     initialize_statements.append(f'{variable} = {value};')
             # function call
-            function_calls.append('  ' * initializer_index + ' '.join(initialize_statements))
-            function_calls.append('  ' * initializer_index + f'int {constants.PREFIX}_cost_{initializer_index} = {function_call};')
+            function_calls.append(indents[initializer_index] + ' '.join(initialize_statements))
+            function_calls.append(indents[initializer_index] + f'int {constants.PREFIX}_cost_{initializer_index} = {function_call};')
             # TODO: simplify the following code, it tries to ask for a proof that makes K <= v_epsilon <= epsilon
             #if has_inputs:
-            function_calls.append('  ' * initializer_index + f'if ({constants.PREFIX}_cost_{initializer_index} {operator} {self._goal})')
+            function_calls.append(indents[initializer_index] + f'if ({constants.PREFIX}_cost_{initializer_index} {operator} {self._goal})')
             #else:
-                #function_calls.append('  ' * initializer_index + f'if ({constants.PREFIX}_cost_{initializer_index} {operator} {self._goal})')
-            function_calls.append('  ' * initializer_index + '{')
+                #function_calls.append(indents[initializer_index] + f'if ({constants.PREFIX}_cost_{initializer_index} {operator} {self._goal})')
+            function_calls.append(indents[initializer_index] + '{')
             # add the final assert
             # if everything is specified (all inputs and alignment array), we should not generate klee_assert statement
             if not (has_inputs and has_alignments) and initializer_index == len(concretes) - 1:
@@ -331,23 +432,20 @@ class Template:
                         f"{constants.PREFIX}_cost_{index} == {constants.SYMBOLIC_COST}[{index}]"
                         for index in range(len(concretes))
                     )
-                function_calls.append('  ' * (initializer_index + 1) + f"if ({symbolic_costs_equal_cost})")
-                function_calls.append('  ' * (initializer_index + 1) + '{')
-                function_calls.append('  ' * (initializer_index + 2) + f'klee_assert(0);')
-                function_calls.append('  ' * (initializer_index + 1) + '}')
+                function_calls.append(indents[initializer_index + 1] + f"if ({symbolic_costs_equal_cost})")
+                function_calls.append(indents[initializer_index + 1] + '{')
+                function_calls.append(indents[initializer_index + 2] + f'klee_assert(0);')
+                function_calls.append(indents[initializer_index + 1] + '}')
 
         # add closing brackets
         for initializer_index in range(len(concretes), 0, -1):
-            function_calls.append('  ' * (initializer_index - 1) + '}')
+            function_calls.append(indents[initializer_index - 1] + '}')
 
-        # create main body
-        main_body = '\n'.join(itertools.chain(declarations, symbolic_statements, assumptions, function_calls))
-        # add indentation for main function
-        main_body = '\n'.join('  ' + statement for statement in main_body.splitlines())
-        header = _HEADER.replace('PENALTY', self._goal)
-        # TODO: temporarily replace all floats with ints
-        function = generate(self._function).replace('float', 'int')
-        # TODO: temporarily replace CHECKDP_SHADOW_DISTANCE_q with CHECKDP_ALIGNED_DISTANCE_q
-        function = function.replace(f'{constants.SHADOW_DISTANCE}_{query_node.name}',
-                                    f'{constants.ALIGNED_DISTANCE}_{query_node.name}')
-        return f'{header}\n{self._random_distances}\n\n{function}\n\nint main(void) {{\n{main_body}\n}}'
+        # create main body, the statements (some of which span multiple lines) are indented for main function and
+        # emitted one by one, so that the main body is never built as a whole when writing to a file
+        statements = itertools.chain(declarations, symbolic_statements, assumptions, function_calls)
+        main_body = (('\n  ' if index != 0 else '  ') + statement.replace('\n', '\n  ')
+                     for index, statement in enumerate(statements))
+        return itertools.chain(
+            (self._header, '\n', self._random_distances, '\n\n', self._function_source, '\n\nint main(void) {\n'),
+            main_body, ('\n}', ))
@@ -1,4 +1,4 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple, FrozenSet
 from dataclasses import dataclass, astuple
 
 
@@ -15,11 +15,19 @@ class _VariableType:
         return f'<{self.aligned_distance}, {self.shadow_distance}, {self.base_type}, {self.is_array}>'
 
 
+# (name, aligned distance, shadow distance, base type, is_array) of each variable
+Snapshot = Tuple[Tuple[str, Optional[str], Optional[str], Optional[str], Optional[bool]], ...]
+
+
 class TypeSystem:
     """ TypeSystem keeps track of the distances of each variable. The distance of each variable is internally
     represented by c_ast node, and gets simplified and casted to strings when get_distance method is called"""
     def __init__(self):
         self._variables: Dict[str, _VariableType] = {}
+        # cached set of the variable names, reset whenever a variable is added or removed
+        self._name_set: Optional[FrozenSet[str]] = None
+        # bumped whenever the types actually change, used to cheaply tell that the types stay unchanged
+        self._revision = 0
 
     def __len__(self):
         return len(self._variables)
@@ -38,11 +46,42 @@ class TypeSystem:
             return False
         return self._variables == other._variables
 
+    @property
+    def revision(self) -> int:
+        """the revision of the type system, which is increased whenever the types are changed"""
+        return self._revision
+
+    def snapshot(self) -> Snapshot:
+        """return an immutable (and hashable) snapshot of the type system, which is much cheaper than deepcopy"""
+        return tuple((name, variable_type.aligned_distance, variable_type.shadow_distance, variable_type.base_type,
+                      variable_type.is_array) for name, variable_type in self._variables.items())
+
+    def restore(self, snapshot: Snapshot):
+        """restore the type system in place from a snapshot returned by snapshot()"""
+        self._variables.clear()
+        self._name_set = None
+        self._revision += 1
+        for name, *types in snapshot:
+            self._variables[name] = _VariableType(*types)
+
+    def copy(self) -> 'TypeSystem':
+        copied = TypeSystem()
+        copied.restore(self.snapshot())
+        return copied
+
     def names(self):
         return self._variables.keys()
 
+    def name_set(self) -> FrozenSet[str]:
+        """return the variable names as a frozenset, which is cached until the set of variables changes"""
+        if self._name_set is None:
+            self._name_set = frozenset(self._variables)
+        return self._name_set
+
     def clear(self):
         self._variables.clear()
+        self._name_set = None
+        self._revision += 1
 
     def variables(self):
         for variable, variable_type in self._variables.items():
@@ -55,6 +94,8 @@ class TypeSystem:
         for name, *types in other.variables():
             if name not in self._variables:
                 self._variables[name] = _VariableType(*types)
+                self._name_set = None
+                self._revision += 1
             else:
                 current_type = self._variables[name]
                 aligned_distance, shadow_distance, base_type, is_array = types
@@ -63,10 +104,14 @@ class TypeSystem:
                                      f'current: ({current_type.base_type}, {current_type.is_array}),'
                                      f'to merge: ({base_type}, {is_array})')
                 # here we will promote the types from the other type system
-                if not (current_type.aligned_distance == aligned_distance == '0'):
+                if not (current_type.aligned_distance == aligned_distance == '0') and \
+                        current_type.aligned_distance != '*':
                     current_type.aligned_distance = '*'
-                if not (current_type.shadow_distance == shadow_distance == '0'):
+                    self._revision += 1
+                if not (current_type.shadow_distance == shadow_distance == '0') and \
+                        current_type.shadow_distance != '*':
                     current_type.shadow_distance = '*'
+                    self._revision += 1
 
     def get_types(self, name):
         return astuple(self._variables[name])
@@ -74,17 +119,25 @@ class TypeSystem:
     def update_base_type(self, name: str, base_type: str, is_array: bool):
         if name not in self._variables:
             self._variables[name] = _VariableType(base_type=base_type, is_array=is_array)
+            self._name_set = None
+            self._revision += 1
         else:
             variable_type = self._variables[name]
-            variable_type.base_type = base_type
-            variable_type.is_array = is_array
+            if (variable_type.base_type, variable_type.is_array) != (base_type, is_array):
+                variable_type.base_type = base_type
+                variable_type.is_array = is_array
+                self._revision += 1
 
     def update_distance(self, name: str, aligned_distance: str, shadow_distance: str):
         if aligned_distance not in ('0', '*') or shadow_distance not in ('0', '*'):
             raise ValueError(f'Distance can only be 0 or *, got {(aligned_distance, shadow_distance)}')
         if name not in self._variables:
             self._variables[name] = _VariableType(aligned_distance=aligned_distance, shadow_distance=shadow_distance)
+            self._name_set = None
+            self._revision += 1
         else:
             variable_type = self._variables[name]
-            variable_type.aligned_distance = aligned_distance
-            variable_type.shadow_distance = shadow_distance
+            if (variable_type.aligned_distance, variable_type.shadow_distance) != (aligned_distance, shadow_distance):
+                variable_type.aligned_distance = aligned_distance
+                variable_type.shadow_distance = shadow_distance
+                self._revision += 1
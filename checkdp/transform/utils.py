@@ -1,4 +1,5 @@
-from typing import Union, Sequence
+from typing import Union, Sequence, Dict
+import functools
 import sympy as sp
 from pycparser.c_parser import CParser
 from pycparser.c_generator import CGenerator
@@ -10,6 +11,10 @@ from checkdp.transform.typesystem import TypeSystem
 __parser = CParser()
 __generator = CGenerator()
 
+# the prefixes of the distance variables, bound to module globals as they are looked up for every visited variable
+_ALIGNED_DISTANCE = constants.ALIGNED_DISTANCE
+_SHADOW_DISTANCE = constants.SHADOW_DISTANCE
+
 ExprType = Union[c_ast.BinaryOp, c_ast.UnaryOp, c_ast.TernaryOp, c_ast.Constant, c_ast.ID, c_ast.FuncCall]
 VariableType = Union[c_ast.ArrayRef, c_ast.ID]
 
@@ -22,14 +27,47 @@ def parse(content: str):
         return __parser.parse(f'int placeholder(){{{content};}}').ext[0].body.block_items[0]
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_expr(content: str) -> c_ast.Node:
+    """parse a single expression (or statement) directly in a placeholder function, unlike parse, it does not first try
+    (and fail) to parse the content as a translation unit. The parsed node is cached and shared, therefore it must be
+    copied (see clone) before being modified or inserted into an AST."""
+    return __parser.parse(f'int placeholder(){{{content};}}').ext[0].body.block_items[0]
+
+
 def generate(node: c_ast.Node):
     return __generator.visit(node)
 
 
+@functools.lru_cache(maxsize=None)
+def distance_name(version: str, name: str) -> str:
+    """return the (interned) name of the distance variable of the given version, e.g., CHECKDP_ALIGNED_DISTANCE_x,
+    the names are repeatedly built for the same variables during the transformation"""
+    return f'{version}_{name}'
+
+
+def clone(node: c_ast.Node) -> c_ast.Node:
+    """copy a (tree-shaped) AST node, pycparser nodes are slotted classes, copying the slots directly is an order of
+    magnitude faster than going through the generic deepcopy protocol. Note that unlike deepcopy, nodes shared
+    by multiple parents are copied separately."""
+    copied = object.__new__(node.__class__)
+    for attribute in node.__slots__:
+        if attribute == '__weakref__':
+            continue
+        value = getattr(node, attribute)
+        if isinstance(value, c_ast.Node):
+            value = clone(value)
+        elif isinstance(value, list):
+            value = [clone(item) if isinstance(item, c_ast.Node) else item for item in value]
+        setattr(copied, attribute, value)
+    return copied
+
+
+@functools.lru_cache(maxsize=None)
 def expr_simplify(expr: str):
     """simplify the string expression by sympy's simplify method. sympy's method automatically simplifies
     multiplications to powers (x*x -> x**2) which is not supported by C. Therefore we use this utility function
-    to wrap up the helper code.
+    to wrap up the helper code. The results are cached since sympy's simplify is expensive.
     """
     def sack(exp):
         return exp.replace(
@@ -39,13 +77,55 @@ def expr_simplify(expr: str):
     return str(sack(sp.simplify(expr)))
 
 
+def _is_side_effect_free(node: c_ast.Node) -> bool:
+    # only variables, constants and arithmetic that cannot trap, e.g., no array accesses, function calls or divisions
+    if isinstance(node, (c_ast.ID, c_ast.Constant)):
+        return True
+    if isinstance(node, c_ast.UnaryOp) and node.op == '-':
+        return _is_side_effect_free(node.expr)
+    if isinstance(node, c_ast.BinaryOp) and node.op in ('+', '-', '*'):
+        return _is_side_effect_free(node.left) and _is_side_effect_free(node.right)
+    return False
+
+
+def _to_bitwise(node: c_ast.Node) -> bool:
+    """rewrite the logical operators in place to the bitwise ones, returns False if the expression is not safe to do so,
+    i.e., not a tree of logical operators over side-effect-free comparisons"""
+    if isinstance(node, c_ast.BinaryOp) and node.op in ('||', '&&'):
+        if not (_to_bitwise(node.left) and _to_bitwise(node.right)):
+            return False
+        node.op = '|' if node.op == '||' else '&'
+        return True
+    return isinstance(node, c_ast.BinaryOp) and node.op in ('==', '!=', '<', '<=', '>', '>=') and \
+        _is_side_effect_free(node.left) and _is_side_effect_free(node.right)
+
+
+def branch_free(condition: str) -> str:
+    """rewrite the short-circuit logical operators of an assumption to bitwise ones, e.g., (x == 0 || x == 1) to
+    (x == 0 | x == 1). Both forms are equivalent when all operands are side-effect-free comparisons, but KLEE forks
+    a new state for each short-circuit branch, which easily leads to path explosions."""
+    # only a single expression is rewritten, the conditions that pycparser cannot parse are kept as they are
+    if ';' in condition:
+        return condition
+    try:
+        node = clone(parse_expr(condition))
+    except ParseError:
+        return condition
+    if not (isinstance(node, c_ast.BinaryOp) and node.op in ('||', '&&')) or not _to_bitwise(node):
+        return condition
+    return generate(node)
+
+
 def is_divergent(type_system: TypeSystem, condition: ExprType) -> Sequence[bool]:
-    # if the condition contains star variable it means the aligned/shadow branch will diverge
-    results = []
-    for type_index in range(2):
-        star_variable_finder = NodeFinder(
-            lambda node: (isinstance(node, c_ast.ID) and type_system.get_types(node.name)[type_index] == '*'))
-        results.append(len(star_variable_finder.visit(condition)) != 0)
+    # if the condition contains star variable it means the aligned/shadow branch will diverge, both versions are
+    # checked in a single walk which stops once both are found
+    results = [False, False]
+    for node in _ID_FINDER.iterate(condition):
+        aligned, shadow, *_ = type_system.get_types(node.name)
+        results[0] = results[0] or aligned == '*'
+        results[1] = results[1] or shadow == '*'
+        if results[0] and results[1]:
+            break
     return results
 
 
@@ -54,29 +134,71 @@ class NodeFinder(c_ast.NodeVisitor):
     def __init__(self, check_func, ignores=None):
         self._check_func = check_func
         self._ignores = ignores
-        self._nodes = []
 
     def visit(self, node):
+        """return a new list of the found nodes in pre-order, the tree is walked with an explicit stack instead of
+        recursive calls"""
         if not node:
             return []
-        self._nodes.clear()
-        super().visit(node)
-        return self._nodes
+        check_func, ignores = self._check_func, self._ignores
+        nodes, stack = [], [node]
+        while stack:
+            node = stack.pop()
+            if ignores and ignores(node):
+                continue
+            if check_func(node):
+                nodes.append(node)
+            # push the children reversely so that they are popped in order
+            stack.extend(reversed(tuple(node)))
+        return nodes
 
-    def generic_visit(self, node):
-        if self._ignores and self._ignores(node):
+    def iterate(self, node):
+        """lazily yield the nodes in the same order as visit, so that the search can stop at the first match"""
+        if not node:
             return
-        if self._check_func(node):
-            self._nodes.append(node)
-        for child in node:
-            self.generic_visit(child)
+        check_func, ignores = self._check_func, self._ignores
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if ignores and ignores(node):
+                continue
+            if check_func(node):
+                yield node
+            stack.extend(reversed(tuple(node)))
+
+
+class _TypeCache:
+    """memoize the types of the variables looked up by a visitor, the cached types are dropped whenever the revision
+    of the type system changes, so the visitors can still be used while the types are being updated"""
+    __slots__ = ('_types', '_revision', '_cache')
+
+    def __init__(self, types: TypeSystem):
+        self._types = types
+        self._revision = types.revision
+        self._cache: Dict[str, tuple] = {}
+
+    def get_types(self, name: str) -> tuple:
+        if self._revision != self._types.revision:
+            self._cache.clear()
+            self._revision = self._types.revision
+        types = self._cache.get(name)
+        if types is None:
+            types = self._cache[name] = self._types.get_types(name)
+        return types
+
+
+# the finder of all the variables, which is stateless and therefore shared
+_ID_FINDER = NodeFinder(lambda node: isinstance(node, c_ast.ID))
 
 
 class ExpressionReplacer(c_ast.NodeVisitor):
     """ this class returns the aligned or shadow version of an expression, e.g., returns e^aligned or e^shadow of e"""
     def __init__(self, types, is_aligned):
-        self._types = types
+        self._types = _TypeCache(types)
         self._is_aligned = is_aligned
+        # the distance variable (ID) nodes are leaves which are never modified afterwards, therefore a single node is
+        # created and shared by all the replacements of the same variable
+        self._distance_variables: Dict[str, c_ast.ID] = {}
 
     def _replace(self, node):
         if not isinstance(node, (c_ast.ArrayRef, c_ast.ID)):
@@ -87,13 +209,15 @@ class ExpressionReplacer(c_ast.NodeVisitor):
         if distance == '0':
             return node
         elif distance == '*':
-            distance_varname = \
-                f'{constants.ALIGNED_DISTANCE if self._is_aligned else constants.SHADOW_DISTANCE}_{varname}'
-            distance_var = c_ast.ArrayRef(name=c_ast.ID(name=distance_varname), subscript=node.subscript) \
-                if isinstance(node, c_ast.ArrayRef) else c_ast.ID(name=distance_varname)
+            distance_id = self._distance_variables.get(varname)
+            if distance_id is None:
+                distance_id = self._distance_variables[varname] = \
+                    c_ast.ID(name=distance_name(_ALIGNED_DISTANCE if self._is_aligned else _SHADOW_DISTANCE, varname))
+            distance_var = c_ast.ArrayRef(name=distance_id, subscript=node.subscript) \
+                if isinstance(node, c_ast.ArrayRef) else distance_id
             return c_ast.BinaryOp(op='+', left=node, right=distance_var)
         else:
-            return c_ast.BinaryOp(op='+', left=node, right=parse(distance))
+            return c_ast.BinaryOp(op='+', left=node, right=clone(parse_expr(distance)))
 
     def visit_BinaryOp(self, node):
         if isinstance(node.left, (c_ast.ArrayRef, c_ast.ID)):
@@ -116,17 +240,47 @@ class ExpressionReplacer(c_ast.NodeVisitor):
         super().visit(node)
         return node
 
+    def rewrite(self, node: ExprType) -> ExprType:
+        """return the replaced version of the expression without modifying it, unlike visit, only the nodes on the
+        paths to the replaced variables are created, the other subtrees are shared with the given expression"""
+        if isinstance(node, c_ast.BinaryOp):
+            left = self._replace(node.left) if isinstance(node.left, (c_ast.ArrayRef, c_ast.ID)) else \
+                self.rewrite(node.left)
+            right = self._replace(node.right) if isinstance(node.right, (c_ast.ArrayRef, c_ast.ID)) else \
+                self.rewrite(node.right)
+            if left is node.left and right is node.right:
+                return node
+            return c_ast.BinaryOp(op=node.op, left=left, right=right, coord=node.coord)
+        elif isinstance(node, c_ast.UnaryOp):
+            expr = self._replace(node.expr) if isinstance(node.expr, (c_ast.ArrayRef, c_ast.ID)) else \
+                self.rewrite(node.expr)
+            return node if expr is node.expr else c_ast.UnaryOp(op=node.op, expr=expr, coord=node.coord)
+        elif isinstance(node, (c_ast.ArrayRef, c_ast.ID, c_ast.Constant)):
+            # variables are only replaced as operands, which is consistent with visit
+            return node
+        # fall back to replace a copy in place for the other expressions
+        return self.visit(clone(node))
+
+
+@functools.lru_cache(maxsize=None)
+def _try_simplify(expr: str) -> str:
+    # sympy's simplify dominates the cost of distance generation, and the same expressions are simplified repeatedly
+    # (e.g., in the iterations of While loops), therefore the results are cached
+    if '[' in expr:
+        # sympy cannot parse the array accesses, the expression is returned as is without trying
+        return expr
+    try:
+        return str(sp.simplify(expr))
+    except Exception:
+        return expr
+
 
 class DistanceGenerator(c_ast.NodeVisitor):
     def __init__(self, types):
-        self._types = types
+        self._types = _TypeCache(types)
 
     def try_simplify(self, expr):
-        from sympy import simplify
-        try:
-            expr = str(simplify(expr))
-        finally:
-            return expr
+        return _try_simplify(expr)
 
     def generic_visit(self, node):
         # TODO: should handle cases like -(-(-(100)))
@@ -143,18 +297,19 @@ class DistanceGenerator(c_ast.NodeVisitor):
 
     def visit_ID(self, n):
         align, shadow, *_ = self._types.get_types(n.name)
-        align = f'({constants.ALIGNED_DISTANCE}_{n.name})' if align == '*' else align
-        shadow = f'({constants.SHADOW_DISTANCE}_{n.name})' if shadow == '*' else shadow
+        align = f'({_ALIGNED_DISTANCE}_{n.name})' if align == '*' else align
+        shadow = f'({_SHADOW_DISTANCE}_{n.name})' if shadow == '*' else shadow
         return align, shadow
 
     def visit_ArrayRef(self, n):
         varname, subscript = n.name.name, generate(n.subscript)
-        align, shadow, *_ = self._types.get_types(n.name.name)
-        align = f'({constants.ALIGNED_DISTANCE}_{varname}[{subscript}])' if align == '*' else align
-        shadow = f'({constants.SHADOW_DISTANCE}_{varname}[{subscript}])' if shadow == '*' else shadow
+        align, shadow, *_ = self._types.get_types(varname)
+        align = f'({_ALIGNED_DISTANCE}_{varname}[{subscript}])' if align == '*' else align
+        shadow = f'({_SHADOW_DISTANCE}_{varname}[{subscript}])' if shadow == '*' else shadow
         return align, shadow
 
     def visit_BinaryOp(self, n):
-        return [self.try_simplify(f'{left} {n.op} {right}')
+        # the distances of arithmetic on static (0-distance) operands are 0, no need to go through sympy
+        return ['0' if left == right == '0' and n.op in ('+', '-', '*') else self.try_simplify(f'{left} {n.op} {right}')
                 for left, right in zip(self.visit(n.left), self.visit(n.right))]
 
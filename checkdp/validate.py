@@ -1,4 +1,6 @@
-from typing import Union, Sequence, Dict
+from typing import Union, Sequence, Dict, Tuple
+import functools
+import hashlib
 import logging
 import re
 import subprocess
@@ -9,30 +11,102 @@ from checkdp.utils import InputType, OutputType
 
 logger = logging.getLogger(__name__)
 
+_RETURN_FINDER = re.compile(r'return\s*(.*)\s*;')
+_ID_MATCHER = re.compile(r'^[_a-zA-Z][_a-zA-Z0-9]*$')
+# the placeholders of the inputs in the PSI template, e.g., $q$
+_PLACEHOLDER_RE = re.compile(r'\$([A-Za-z_][A-Za-z_0-9]*)\$')
+# PSI uses [] to represent parentheses
+_BRACKETS = str.maketrans('[]', '()')
+# the trivial values in the cancelled probability
+_TRIVIAL_VALUES = {'Boole(True)': '1', 'Boole(False)': '0', 'DiracDelta(0)': '1'}
+_TRIVIAL_VALUE_RE = re.compile('|'.join(map(re.escape, _TRIVIAL_VALUES)))
+
+
+@functools.lru_cache(maxsize=64)
+def _declaration_pattern(variable: str) -> re.Pattern:
+    """return the compiled pattern for the declaration of the variable in the PSI template"""
+    return re.compile(variable + r'\s*:=\s*(\(\[\s*\]\s*:\s*R\[\s*\]\));')
+
+
+@functools.lru_cache(maxsize=64)
+def _output_pattern(variable: str) -> re.Pattern:
+    """return the compiled pattern for the elements of the output variable in the pdf, e.g., o0, o1"""
+    return re.compile(re.escape(variable) + r'(\d+)')
+
+
+@functools.lru_cache(maxsize=2048)
+def _cancel(expression: str) -> str:
+    # the concretized pdfs of different bad outputs (or inputs) often coincide, therefore the expensive sympy calls
+    # are cached by the expression strings
+    return str(sp.cancel(expression))
+
+
+@functools.lru_cache(maxsize=2048)
+def _evaluate(expression: str) -> float:
+    expression = sp.sympify(expression)
+    # the concretized expression is usually closed-form, which can be evaluated numerically without simplifying
+    # it first, the general simplification is only needed when it cannot be (e.g., unresolved function calls)
+    if not expression.free_symbols:
+        try:
+            return float(expression.evalf())
+        except TypeError:
+            pass
+    return float(sp.simplify(expression).evalf())
+
+
+@functools.lru_cache(maxsize=4096)
+def _concretize_probability(pdf: str, output_variable: str, bad_output: Tuple) -> float:
+    # replace the variables in the pdf expression with concrete values of bad output in a single pass
+    values = tuple(map(str, bad_output))
+
+    def substitute(match):
+        index = int(match.group(1))
+        return values[index] if index < len(values) else match.group(0)
+    pdf = _output_pattern(output_variable).sub(substitute, pdf)
+    # finally replace the length variable
+    pdf = pdf.replace('length', str(len(bad_output)))
+
+    logger.debug('Start evaluating...')
+    # replace [ with ( and ] with ) since PSI uses [] to represent parentheses where PSI does not recognize
+    probability = pdf.translate(_BRACKETS)
+    # use sympy to first cancel out the trivial parts
+    probability = _cancel(probability)
+    # replace the trivial values
+    probability = _TRIVIAL_VALUE_RE.sub(lambda match: _TRIVIAL_VALUES[match.group(0)], probability)
+    logger.debug('Final probability: {}'.format(probability))
+    # now run sympy to simplify the final transformed expression, we should have a constant now
+    return _evaluate(probability)
+
 
 class PSI:
     def __init__(self, psi_binary: str, output_dir: Path):
         self._binary = psi_binary
         self._output_dir = output_dir
-        self._return_finder = re.compile(r'return\s*(.*)\s*;')
-        self._id_matcher = re.compile(r'^[_a-zA-Z][_a-zA-Z0-9]*$')
+        # the pdfs returned by PSI, keyed by the filled template, since PSI is expensive to run and the same filled
+        # templates recur across validations. Note that the filled template only depends on the length of the bad
+        # output (the pdf is symbolic in the output elements, which are concretized afterwards), therefore PSI is run
+        # once for all the bad outputs of the same length
+        self._pdf_cache: Dict[str, str] = {}
+        # the preprocessed templates (template, returned variable) keyed by their paths, since the same template is
+        # validated for each of the bad outputs
+        self._templates: Dict[str, Tuple[str, str]] = {}
 
     def _preprocess(self, template: str) -> str:
         """preprocesses the template file, report any errors that are not consistent with our assumptions and then
         return the output variable name"""
-        returns = self._return_finder.findall(template)
+        returns = _RETURN_FINDER.findall(template)
         if len(returns) > 1:
             raise NotImplementedError('Multiple return statement found, currently only supporting single return')
         if len(returns) == 0:
             raise ValueError('No return statement found')
 
         returned_variable = returns[0]
-        if self._id_matcher.match(returned_variable) is None:
+        if _ID_MATCHER.match(returned_variable) is None:
             raise NotImplementedError('Currently does not support returning expressions, '
                                       'please add it to a list and return the list instead')
 
         # check if the returned variable is indeed a list
-        declaration = re.findall(returned_variable + r'\s*:=\s*(\(\[\s*\]\s*:\s*R\[\s*\]\));', template)
+        declaration = _declaration_pattern(returned_variable).findall(template)
         if len(declaration) == 0:
             raise ValueError(f'Cannot find declaration for the output variable {returned_variable}')
 
@@ -44,22 +118,8 @@ class PSI:
 
     @staticmethod
     def concretize_probability(pdf: str, output_variable: str, bad_output: OutputType) -> float:
-        # replace the variables in the pdf expression with concrete values of bad output
-        for index, value in enumerate(bad_output):
-            pdf = pdf.replace(f'{output_variable}{index}', str(value))
-        # finally replace the length variable
-        pdf = pdf.replace('length', str(len(bad_output)))
-
-        logger.debug('Start evaluating...')
-        # replace [ with ( and ] with ) since PSI uses [] to represent parentheses where PSI does not recognize
-        probability = pdf.replace('[', '(').replace(']', ')')
-        # use sympy to first cancel out the trivial parts
-        probability = str(sp.cancel(probability))
-        # replace the trivial values
-        probability = probability.replace('Boole(True)', '1').replace('Boole(False)', '0').replace('DiracDelta(0)', '1')
-        logger.debug('Final probability: {}'.format(probability))
-        # now run sympy to simplify the final transformed expression, we should have a constant now
-        return float(sp.simplify(probability).evalf())
+        # the evaluation is cached since sympy's cancel and simplify are expensive
+        return _concretize_probability(pdf, output_variable, tuple(bad_output))
 
     def validate(self, template: Union[str, os.PathLike],
                  inputs_1: InputType, inputs_2: InputType, bad_output: OutputType) -> Sequence[float]:
@@ -78,42 +138,68 @@ class PSI:
         query_variable = differences[0][0]
 
         # read the PSI template file
-        with open(template, 'r') as f:
-            template = f.read()
-
-        returned_variable = self._preprocess(template)
-
-        results = []
+        template_path = os.fspath(template)
+        if template_path not in self._templates:
+            with open(template_path, 'r') as f:
+                content = f.read()
+            self._templates[template_path] = (content, self._preprocess(content))
+        template, returned_variable = self._templates[template_path]
+
+        logger.debug('Evaluating bad output {}'.format(bad_output))
+        # replace the array of output to separate element and a length, which is the same for both inputs
+        template = _RETURN_FINDER.sub(
+            f"return ({','.join(['{}[{}]'.format(returned_variable, i) for i in range(len(bad_output))])},"
+            f"{returned_variable}.length);",
+            template)
+
+        contents = []
         for inputs in (inputs_1, inputs_2):
-            # fill in the PSI template with concrete values from inputs and outputs
-            content = str(template)
-            for name, value in inputs.items():
-                # convert tuple to list, since PSI doesn't support the format of tuple
-                value = list(value) if isinstance(value, tuple) else value
-                content = content.replace('${}$'.format(name), str(value))
-
-            logger.debug('Evaluating bad output {}'.format(bad_output))
-
-            # replace the array of output to separate element and a length
-            content = self._return_finder.sub(
-                f"return ({','.join(['{}[{}]'.format(returned_variable, i) for i in range(len(bad_output))])},"
-                f"{returned_variable}.length);",
-                content)
-
-            input_sequence = '_'.join(map(str, inputs[query_variable]))
-            output_sequence = '_'.join(map(str, bad_output))
-            output_file = str((self._output_dir / f"psi_input_{input_sequence}_output_{output_sequence}.psi").resolve())
-            # now write the filled template to a file to pass to psi
-            with open(output_file, 'w') as f:
-                f.write(content)
-
-            # now run the psi process
-            process = subprocess.run([self._binary, '--mathematica', '--raw', output_file], capture_output=True)
-            err = process.stderr.decode('utf-8')
-            if len(err) > 0:
-                raise ValueError('PSI returned with error message {}'.format(err))
-            pdf = process.stdout.decode('utf-8')
+            # fill in the PSI template with concrete values from inputs in a single pass, the tuples are converted to
+            # lists since PSI doesn't support the format of tuple
+            values = {name: str(list(value) if isinstance(value, tuple) else value) for name, value in inputs.items()}
+            contents.append(_PLACEHOLDER_RE.sub(lambda match: values.get(match.group(1), match.group(0)), template))
+
+        # the PSI processes of the inputs are independent, therefore they are started together and run concurrently
+        # the outputs of psi are written directly to files (next to the filled templates) instead of being buffered in
+        # pipes, which keeps only the final decoded pdf in memory
+        processes: Dict[str, Tuple[subprocess.Popen, Path]] = {}
+        try:
+            for inputs, content in zip((inputs_1, inputs_2), contents):
+                if content in self._pdf_cache or content in processes:
+                    continue
+                # the file is named after the filled template, the same input sequence (or output length) can give
+                # different templates, e.g., when the inputs only differ in the other parameters
+                input_sequence = '_'.join(map(str, inputs[query_variable]))
+                digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+                output_file = str((self._output_dir / f"psi_input_{input_sequence}_{digest}.psi").resolve())
+                # now write the filled template to a file to pass to psi
+                with open(output_file, 'w') as f:
+                    f.write(content)
+
+                # now start the psi process
+                pdf_file = Path(output_file).with_suffix('.pdf')
+                with open(pdf_file, 'wb') as f:
+                    process = subprocess.Popen([self._binary, '--mathematica', '--raw', output_file],
+                                               stdout=f, stderr=subprocess.PIPE)
+                processes[content] = (process, pdf_file)
+
+            for content, (process, pdf_file) in processes.items():
+                _, err = process.communicate()
+                err = err.decode('utf-8')
+                if len(err) > 0:
+                    raise ValueError('PSI returned with error message {}'.format(err))
+                with open(pdf_file, 'r', encoding='utf-8', newline='') as f:
+                    self._pdf_cache[content] = f.read()
+        finally:
+            # do not leave the other psi process running if one fails
+            for process, _ in processes.values():
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
 
+        results = []
+        for inputs, content in zip((inputs_1, inputs_2), contents):
+            pdf = self._pdf_cache[content]
             logger.debug('The PDF of M({} \\in {}) is {}'.format(inputs[query_variable], bad_output, pdf))
             results.append(self.concretize_probability(pdf, returned_variable, bad_output))
 
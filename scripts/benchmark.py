@@ -4,6 +4,7 @@ import os
 import re
 import sys
 import shutil
+import threading
 import time
 import argparse
 import tqdm
@@ -36,6 +37,13 @@ async def check(file_path, output_folder):
     return file_path.stem, out.decode('utf-8'), err.decode('utf-8')
 
 
+async def refresh(bar):
+    # periodically refresh the progress bar so we have a precise time tracking
+    while True:
+        await asyncio.sleep(1)
+        bar.refresh()
+
+
 async def main(argv=sys.argv[1:]):
     # parse the arguments
     arg_parser = argparse.ArgumentParser(description=__doc__)
@@ -50,9 +58,11 @@ async def main(argv=sys.argv[1:]):
     # remove existing results folder and create a new one
     result_folder = module_folder / 'results'
     if result_folder.exists():
-        print('Found previous results folder, removing..')
-        shutil.rmtree(result_folder)
-        print('Previous results folder removed.')
+        print('Found previous results folder, removing in the background..')
+        # move the previous results out of the way and remove them while the benchmark runs
+        trash_folder = result_folder.with_name('{}.old-{}'.format(result_folder.name, os.getpid()))
+        result_folder.rename(trash_folder)
+        threading.Thread(target=shutil.rmtree, args=(trash_folder, ), kwargs={'ignore_errors': True}).start()
     os.mkdir(result_folder)
 
     # find out all source files ending with .c in the example folder
@@ -82,41 +92,33 @@ async def main(argv=sys.argv[1:]):
     # those finished examples
     finished = set()
     error_check = re.compile(r'error|exception', re.IGNORECASE)
-    for task in bar:
-        # periodically wake up from "sleep 1 second" task to refresh the progress bar so we have a precise time tracking
-        while True:
-            sleep_task = asyncio.ensure_future(asyncio.sleep(1))
-            done, pending = await asyncio.wait([task, sleep_task], return_when=asyncio.FIRST_COMPLETED)
-            bar.refresh()
-            if sleep_task in done:
-                # woke up from sleep task, re-assign the actual task to be awaited in next iteration
-                task = pending.pop()
+    # a single background task refreshes the progress bar while the examples are being awaited
+    refresh_task = asyncio.ensure_future(refresh(bar))
+    try:
+        for task in bar:
+            # get the example name from the task
+            name, out, err = await task
+            finished.add(name)
+            for output in (out, err):
+                if error_check.search(output) is not None:
+                    print(output)
+
+            # check if the results are consistent with the problem name
+            with open(result_folder / name / 'run.log', 'r') as f:
+                content = f.read()
+                is_ok = ('Result: Alignment Found' in content and not name.startswith('bad')) or \
+                    ('Result: Counterexample Found' in content and name.startswith('bad'))
+
+            # log the message and update progress bar description
+            bar.write('Finished checking {} in {:0.1f} seconds, reports can be found at {}, result: {}'.format(
+                name, time.time() - start_time, str(result_folder / name), success('ok') if is_ok else fail('not ok')))
+            remaining = tuple(filter(lambda x: x not in finished, coroutines.keys()))
+            if len(remaining) == 0:
+                bar.set_description('Done')
             else:
-                # woke up from the actual task, therefore cancel the sleep task and break the loop
-                pending.pop().cancel()
-                task = done.pop()
-                break
-        # get the example name from the task
-        name, out, err = await task
-        finished.add(name)
-        for output in (out, err):
-            if error_check.search(output) is not None:
-                print(output)
-
-        # check if the results are consistent with the problem name
-        with open(result_folder / name / 'run.log', 'r') as f:
-            content = f.read()
-            is_ok = ('Result: Alignment Found' in content and not name.startswith('bad')) or \
-                ('Result: Counterexample Found' in content and name.startswith('bad'))
-
-        # log the message and update progress bar description
-        bar.write('Finished checking {} in {:0.1f} seconds, reports can be found at {}, result: {}'.format(
-            name, time.time() - start_time, str(result_folder / name), success('ok') if is_ok else fail('not ok')))
-        remaining = tuple(filter(lambda x: x not in finished, coroutines.keys()))
-        if len(remaining) == 0:
-            bar.set_description('Done')
-        else:
-            bar.set_description('[{}]'.format(ellipsize(' '.join(remaining))))
+                bar.set_description('[{}]'.format(ellipsize(' '.join(remaining))))
+    finally:
+        refresh_task.cancel()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,49 @@
+from pathlib import Path
+import checkdp.transform.constants as constants
+from checkdp.core import run, _concrete_key
+from checkdp.transform import transform
+from tests.utils import example_folder
+
+
+def test_concrete_key():
+    assert _concrete_key({'q': [1, 2], 'x': 1}) == _concrete_key({'x': 1.0, 'q': (1, 2)})
+    assert _concrete_key({'q': [1, 2], 'x': 1}) != _concrete_key({'q': [2, 1], 'x': 1})
+
+
+class _Clang:
+    def compile_bytecode_cached(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        Path(output).touch()
+
+    async def async_compile_binary(self, source, output, include_dirs=(), library_dirs=(), extra_args=()):
+        # the "binary" simply outputs a fixed bad output
+        Path(output).write_text('#!/bin/sh\necho 1\n')
+
+
+class _KLEE:
+    """returns the given results in order"""
+    def __init__(self, results):
+        self.sources = []
+        self._results = list(results)
+
+    def run(self, source, type_system, is_maximize):
+        self.sources.append(source)
+        return self._results.pop(0)
+
+    def reset(self):
+        pass
+
+
+def test_skip_uncoverable_counterexamples(tmp_path: Path):
+    with (example_folder / 'partialsum.c').open() as f:
+        template = transform(f.read())
+    counterexample = {'q': [1, 0, 0, 0, 0], f'{constants.ALIGNED_DISTANCE}_q': [1, 0, 0, 0, 0],
+                      constants.SAMPLE_ARRAY: [0]}
+    # a counterexample is found by the default alignment, but no alignment can cover it
+    klee = _KLEE([counterexample, None])
+    result = run(template, klee, _Clang(), tmp_path)
+    # the final validation searches alignments for the same counterexample again, which is skipped without
+    # generating the program or running KLEE
+    assert len(klee.sources) == 2
+    assert (tmp_path / 'generate-alignments-1.c').exists()
+    assert not (tmp_path / 'generate-alignments-1002.c').exists()
+    assert result == (False, counterexample, [['1'], ['1']])
@@ -0,0 +1,163 @@
+from typing import List
+from pathlib import Path
+import shutil
+import pytest
+from checkdp.symex import Z3, _concretize
+
+# z3 outputs of a single 4-byte variable x
+_SAT = 'sat\n(((concat (select x (_ bv3 32)) (select x (_ bv2 32))) #x00000005))\n'
+_UNSAT = 'unsat\n(error "line 5 column 10: model is not available")\n'
+
+
+class _Solver:
+    """records the queries and answers them in order"""
+    def __init__(self, outputs: List[str]):
+        self.queries = []
+        self._outputs = list(outputs)
+
+    def __call__(self, commands: List[str]) -> str:
+        self.queries.append(list(commands))
+        return self._outputs.pop(0)
+
+
+@pytest.fixture
+def z3(tmp_path: Path):
+    z3_obj = Z3('z3', tmp_path)
+    yield z3_obj
+    z3_obj.close()
+
+
+def test_cache(z3: Z3, monkeypatch):
+    solver = _Solver([_SAT, _UNSAT])
+    monkeypatch.setattr(z3, '_interactive_solve', solver)
+    assert z3.solve(['(assert a)'], {'x': 4}) == (True, {'x': (5, )})
+    # the result of the same query is cached, a copy is returned so the caller can modify it
+    is_sat, objects = z3.solve(['(assert a)'], {'x': 4})
+    assert (is_sat, objects) == (True, {'x': (5, )})
+    objects['x'] = 0
+    assert z3.solve(['(assert a)'], {'x': 4}) == (True, {'x': (5, )})
+    assert len(solver.queries) == 1
+    # different constraints or variables are not answered by the cache
+    assert z3.solve(['(assert b)'], {'x': 4}) == (False, {'x': (0, )})
+    assert len(solver.queries) == 2
+
+
+def test_unsat_superset(z3: Z3, monkeypatch):
+    solver = _Solver([_UNSAT, _SAT])
+    monkeypatch.setattr(z3, '_interactive_solve', solver)
+    assert z3.solve(['(assert a)', '(assert b)'], {'x': 4})[0] is False
+    # any superset of an unsatisfiable constraint set is unsatisfiable, therefore not sent to z3
+    assert z3.solve(['(assert b)', '(assert c)', '(assert a)'], {'x': 4}) == (False, {})
+    assert len(solver.queries) == 1
+    # while a subset is still solved
+    assert z3.solve(['(assert a)'], {'x': 4}) == (True, {'x': (5, )})
+    assert len(solver.queries) == 2
+
+
+def test_oneshot_fallback(z3: Z3, monkeypatch):
+    def broken(commands: List[str]) -> str:
+        raise BrokenPipeError('z3 process exited unexpectedly')
+
+    solver = _Solver([_SAT])
+
+    async def oneshot(commands: List[str]) -> str:
+        return solver(commands)
+
+    monkeypatch.setattr(z3, '_interactive_solve', broken)
+    monkeypatch.setattr(z3, '_oneshot_solve', oneshot)
+    assert z3.solve(['(assert a)'], {'x': 4}) == (True, {'x': (5, )})
+    assert len(solver.queries) == 1
+    query = solver.queries[0]
+    assert query[0] == '(assert a)' and '(check-sat)' in query and query[-1] == '(exit)'
+
+
+@pytest.mark.parametrize('output', ['unknown\n', '(error "line 1 column 1: invalid command")\nunsat\n', ''])
+def test_unexpected_result(z3: Z3, monkeypatch, output: str):
+    solver = _Solver([output, output, output, _SAT])
+    monkeypatch.setattr(z3, '_interactive_solve', solver)
+
+    async def oneshot(commands: List[str]) -> str:
+        return solver(commands)
+
+    monkeypatch.setattr(z3, '_oneshot_solve', oneshot)
+    # the unexpected result is retried by a one-shot z3 process, and then reported
+    with pytest.raises(ValueError):
+        z3.solve(['(assert a)'], {'x': 4})
+    assert len(solver.queries) == 2
+    # neither cached nor treated as unsatisfiable
+    assert z3.solve(['(assert a)', '(assert b)'], {'x': 4}) == (True, {'x': (5, )})
+    assert len(solver.queries) == 4
+
+
+def _word(variable: str) -> str:
+    # the 32-bit (little-endian) integer stored in the first 4 bytes of the symbolic array
+    return f'(concat (select {variable} (_ bv3 32)) (concat (select {variable} (_ bv2 32)) ' \
+           f'(concat (select {variable} (_ bv1 32)) (select {variable} (_ bv0 32)))))'
+
+
+def _query(*assertions: str) -> List[str]:
+    # a query in the format of kleaver --print-smtlib, with the (check-sat) and (exit) lines removed
+    return ['(set-logic QF_AUFBV )', '(declare-fun x () (Array (_ BitVec 32) (_ BitVec 8) ) )',
+            *(f'(assert {assertion})' for assertion in assertions), f'(maximize {_word("x")})']
+
+
+@pytest.mark.skipif(shutil.which('z3') is None, reason='z3 is not installed')
+def test_real_z3(tmp_path: Path):
+    z3_obj = Z3(shutil.which('z3'), tmp_path)
+    try:
+        # the queries are solved in push / pop frames of the same process, the declarations and assertions of the
+        # previous queries must not leak into the next ones
+        for _ in range(2):
+            assert z3_obj.solve(_query(f'(bvult {_word("x")} (_ bv10 32))'), {'x': 4}) == (True, {'x': (9, )})
+            assert z3_obj.solve(_query(f'(bvult {_word("x")} (_ bv10 32))', f'(bvugt {_word("x")} (_ bv20 32))'),
+                                {'x': 4}) == (False, {'x': (0, )})
+            z3_obj.reset()
+        # the values are decoded as signed integers
+        assert z3_obj.solve(_query(f'(= {_word("x")} #xfffffffc)'), {'x': 4}) == (True, {'x': (-4, )})
+    finally:
+        z3_obj.close()
+
+
+@pytest.mark.skipif(shutil.which('z3') is None, reason='z3 is not installed')
+def test_real_z3_oneshot(tmp_path: Path, monkeypatch):
+    def broken(commands: List[str]) -> str:
+        raise BrokenPipeError('z3 process exited unexpectedly')
+
+    z3_obj = Z3(shutil.which('z3'), tmp_path)
+    monkeypatch.setattr(z3_obj, '_interactive_solve', broken)
+    assert z3_obj.solve(_query(f'(bvult {_word("x")} (_ bv10 32))'), {'x': 4}) == (True, {'x': (9, )})
+    assert z3_obj.solve(_query(f'(bvult {_word("x")} (_ bv10 32))', f'(bvugt {_word("x")} (_ bv20 32))'),
+                        {'x': 4}) == (False, {'x': (0, )})
+
+
+def test_concretize():
+    constraints = [
+        '(set-logic QF_AUFBV )',
+        '(declare-fun q () (Array (_ BitVec 32) (_ BitVec 8) ) )',
+        '(declare-fun r () (Array (_ BitVec 32) (_ BitVec 8) ) )',
+        # both orientations of the defining equality, in both formats of the constants
+        '(assert (=  #x05 (select  q (_ bv0 32) ) ) )',
+        '(assert (= (select q (_ bv1 32)) (_ bv3 8)))',
+        '(assert (bvslt (select q (_ bv0 32)) (concat (select q (_ bv1 32)) (select q (_ bv2 32)))))',
+        # selects on other arrays or other indices are kept
+        '(assert (= (select r (_ bv0 32)) (select q (_ bv0 32))))',
+        # a conflicting definition is substituted as well, so that the constraints remain unsatisfiable
+        '(assert (=  #x07 (select  q (_ bv0 32) ) ) )',
+        '(check-sat)',
+    ]
+    assert _concretize(constraints) == [
+        *constraints[:5],
+        '(assert (bvslt #x05 (concat (_ bv3 8) (select q (_ bv2 32)))))',
+        '(assert (= (select r (_ bv0 32)) #x05))',
+        '(assert (=  #x07 #x05 ) )',
+        '(check-sat)',
+    ]
+
+
+def test_concretize_unchanged():
+    # no bytes are fixed to concrete values
+    constraints = [
+        '(assert (= (select r (_ bv0 32)) (select q (_ bv0 32))))',
+        '(assert (bvslt #x05 (select q (_ bv1 32))))',
+    ]
+    assert _concretize(constraints) == constraints
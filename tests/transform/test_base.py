@@ -0,0 +1,23 @@
+import re
+from checkdp.transform.preprocess import Preprocessor
+from checkdp.transform.base import Transformer
+from checkdp.transform.postprocess import PostProcessor
+from checkdp.transform.utils import parse, generate
+from tests.utils import example_folder
+
+# the comments in the example files
+_COMMENT_PATTERN = re.compile(r'\/\/.*|\/\*.*\*\/')
+
+
+def test_input_unchanged():
+    for enable_shadow in (False, True):
+        with open(example_folder / 'noisymax.c') as f:
+            node = parse(_COMMENT_PATTERN.sub('', f.read()))
+        preprocessed, type_system, *_ = Preprocessor().process(node)
+        before = generate(preprocessed)
+        transformed, type_system = Transformer(type_system, enable_shadow=enable_shadow).transform(preprocessed)
+        # post process the transformed function in place, which appends the generated parameters and changes the
+        # return type
+        PostProcessor(type_system, custom_variables=()).visit_FuncDef(transformed)
+        assert generate(preprocessed) == before
+        assert generate(transformed) != before
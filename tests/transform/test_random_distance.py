@@ -1,20 +1,27 @@
-from typing import Dict, Tuple, Set
+from typing import Dict, Tuple, Set, Sequence, List
 import re
 from pathlib import Path
-from checkdp.transform.random_distance import RandomDistanceGenerator
+import checkdp.transform.constants as constants
+from checkdp.transform.random_distance import RandomDistanceGenerator, AlignmentIndexType, _generate_random_distance
 from checkdp.transform.preprocess import Preprocessor
 from checkdp.transform.base import Transformer
 from checkdp.transform.utils import parse
 from tests.utils import example_folder
 
+# the comments in the example files
+_COMMENT_PATTERN = re.compile(r'\/\/.*|\/\*.*\*\/')
 
-def assert_templates(name: str, templates: Dict[str, Tuple[Set[str], Set[str]]], enable_shadow=False):
+
+def transform_example(name: str, enable_shadow=False):
     # remove comments
-    pattern = re.compile(r'\/\/.*|\/\*.*\*\/')
     with open(example_folder / Path(name).with_suffix('.c')) as f:
-        node = parse(pattern.sub('', f.read()))
+        node = parse(_COMMENT_PATTERN.sub('', f.read()))
     preprocessed, type_system, preconditions, hole_preconditions, goal = Preprocessor().process(node)
-    transformed, type_system = Transformer(type_system, enable_shadow=enable_shadow).transform(preprocessed)
+    return Transformer(type_system, enable_shadow=enable_shadow).transform(preprocessed)
+
+
+def assert_templates(name: str, templates: Dict[str, Tuple[Set[str], Set[str]]], enable_shadow=False):
+    transformed, type_system = transform_example(name, enable_shadow)
     generate_templates = RandomDistanceGenerator(type_system).generate(transformed)
     for name, (conditions, variables) in generate_templates.items():
         assert name in templates, f'Template for {name} is generated but not specified'
@@ -47,3 +54,72 @@ def test_partialsum():
 
 def test_noisymax():
     assert_templates('noisymax', {'eta': ({'((q[i] + eta) > bq) || (i == 0)'}, {'bq', 'q[i]'})}, enable_shadow=True)
+
+
+def _recursive_random_distance(conditions: Sequence[str], variables: Sequence[str],
+                               alignment_array_types: List[AlignmentIndexType], is_selector=False) -> str:
+    """the original recursive template generation, used as the reference of the default (non-shared) templates"""
+    start_index = len(alignment_array_types)
+    if len(conditions) == 0:
+        template_parts = [f'{constants.ALIGNMENT_ARRAY}[{start_index}]']
+        alignment_array_types.append(AlignmentIndexType.Selector if is_selector else AlignmentIndexType.Constant)
+        for index, variable in enumerate(variables):
+            template_parts.append(f'{constants.ALIGNMENT_ARRAY}[{start_index + 1 + index}] * {variable}')
+            alignment_array_types.append(AlignmentIndexType.Variable)
+        return '(' + ' + '.join(template_parts) + ')'
+    left = _recursive_random_distance(conditions[1:], variables, alignment_array_types, is_selector)
+    right = _recursive_random_distance(conditions[1:], variables, alignment_array_types, is_selector)
+    return f'{conditions[0]} ? {left} : {right}'
+
+
+def test_random_distance_default():
+    conditions, variables = ('c0', 'c1', 'c2'), ('x', 'y[i]')
+    for depth in range(len(conditions) + 1):
+        for is_selector in (False, True):
+            for used_variables in (variables, ()):
+                # start from a non-empty alignment array to check the indices are offset correctly
+                types, expected_types = [AlignmentIndexType.Constant], [AlignmentIndexType.Constant]
+                template = _generate_random_distance(conditions[:depth], used_variables, types, is_selector)
+                expected = _recursive_random_distance(conditions[:depth], used_variables, expected_types, is_selector)
+                assert template == expected
+                assert types == expected_types
+
+
+def test_random_distance_share_leaves():
+    types = []
+    template = _generate_random_distance(('c0', 'c1'), ('x', 'y'), types, share_leaves=True)
+    assert template == f'({constants.ALIGNMENT_ARRAY}[0] + {constants.ALIGNMENT_ARRAY}[1] * x + ' \
+                       f'{constants.ALIGNMENT_ARRAY}[2] * y)'
+    assert types == [AlignmentIndexType.Constant, AlignmentIndexType.Variable, AlignmentIndexType.Variable]
+
+    types = [AlignmentIndexType.Constant]
+    template = _generate_random_distance(('c0', 'c1'), (), types, is_selector=True, share_leaves=True)
+    assert template == f'({constants.ALIGNMENT_ARRAY}[1])'
+    assert types == [AlignmentIndexType.Constant, AlignmentIndexType.Selector]
+
+
+def test_noisymax_share_alignments():
+    macros = {}
+    for share_alignments in (False, True):
+        transformed, type_system = transform_example('noisymax', enable_shadow=True)
+        generator = RandomDistanceGenerator(type_system, enable_shadow=True, share_alignments=share_alignments)
+        macros[share_alignments] = generator.generate_macros(transformed)
+
+    condition = '((q[i] + eta) > bq) || (i == 0)'
+    # the default templates branch on the condition, i.e., one leaf for each branch
+    inserted, alignment_array_types = macros[False]
+    selector, random_distance = inserted.split('\n')
+    assert selector == f'#define {constants.SELECTOR}_eta ({condition} ? ({constants.ALIGNMENT_ARRAY}[0]) : ' \
+                       f'({constants.ALIGNMENT_ARRAY}[1]))'
+    assert random_distance.startswith(f'#define {constants.RANDOM_DISTANCE}_eta ({condition} ? ')
+    assert len(alignment_array_types) == 2 + 2 * 3
+
+    # the shared templates drop the condition and only have a single leaf with one index for each variable (bq and
+    # q[i]) plus the constant
+    inserted, alignment_array_types = macros[True]
+    selector, random_distance = inserted.split('\n')
+    assert selector == f'#define {constants.SELECTOR}_eta (({constants.ALIGNMENT_ARRAY}[0]))'
+    assert random_distance.startswith(f'#define {constants.RANDOM_DISTANCE}_eta (({constants.ALIGNMENT_ARRAY}[1] + ')
+    assert condition not in random_distance
+    assert alignment_array_types == [AlignmentIndexType.Selector, AlignmentIndexType.Constant,
+                                     AlignmentIndexType.Variable, AlignmentIndexType.Variable]
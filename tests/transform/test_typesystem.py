@@ -0,0 +1,80 @@
+import pytest
+from checkdp.transform.typesystem import TypeSystem
+
+
+def create_type_system(*names: str) -> TypeSystem:
+    type_system = TypeSystem()
+    for name in names:
+        type_system.update_distance(name, '0', '0')
+        type_system.update_base_type(name, 'int', name == 'q')
+    return type_system
+
+
+def test_snapshot():
+    type_system = create_type_system('q', 'x')
+    snapshot = type_system.snapshot()
+    assert snapshot == (('q', '0', '0', 'int', True), ('x', '0', '0', 'int', False))
+    hash(snapshot)
+    # the snapshot is not affected by later changes
+    type_system.update_distance('x', '*', '0')
+    assert snapshot == (('q', '0', '0', 'int', True), ('x', '0', '0', 'int', False))
+
+
+def test_restore():
+    type_system = create_type_system('q', 'x')
+    snapshot = type_system.snapshot()
+    type_system.update_distance('x', '*', '*')
+    type_system.update_distance('y', '0', '*')
+    assert type_system.name_set() == {'q', 'x', 'y'}
+    type_system.restore(snapshot)
+    assert type_system.snapshot() == snapshot
+    assert type_system.name_set() == {'q', 'x'}
+    assert type_system.get_types('x') == ('0', '0', 'int', False)
+
+    # the restored type system does not share the variable types with the original one
+    copied = TypeSystem()
+    copied.restore(type_system.snapshot())
+    copied.update_distance('x', '*', '0')
+    assert type_system.get_types('x') == ('0', '0', 'int', False)
+    assert copied.get_types('x') == ('*', '0', 'int', False)
+
+
+def test_revision():
+    type_system = create_type_system('q', 'x')
+    revision = type_system.revision
+    # updates that do not change the types keep the revision
+    type_system.update_distance('x', '0', '0')
+    type_system.update_base_type('q', 'int', True)
+    type_system.merge(create_type_system('x'))
+    assert type_system.revision == revision
+
+    for update in (lambda: type_system.update_distance('x', '*', '0'),
+                   lambda: type_system.update_base_type('x', 'float', False),
+                   lambda: type_system.update_distance('y', '0', '0'),
+                   lambda: type_system.merge(create_type_system('z')),
+                   lambda: type_system.restore(type_system.snapshot()),
+                   type_system.clear):
+        update()
+        assert type_system.revision > revision
+        revision = type_system.revision
+
+
+def test_merge():
+    type_system = create_type_system('q', 'x')
+    other = create_type_system('x', 'y')
+    other.update_distance('x', '0', '*')
+    type_system.merge(other)
+    assert type_system.get_types('x') == ('0', '*', 'int', False)
+    assert type_system.get_types('y') == ('0', '0', 'int', False)
+    # the base types must match
+    array_x = create_type_system('x')
+    array_x.update_base_type('x', 'int', True)
+    with pytest.raises(ValueError):
+        type_system.merge(array_x)
+
+
+def test_equality():
+    # the order of the variables does not matter
+    assert create_type_system('q', 'x') == create_type_system('x', 'q')
+    assert create_type_system('q', 'x').snapshot() != create_type_system('x', 'q').snapshot()
+    assert create_type_system('q', 'x') != create_type_system('q')
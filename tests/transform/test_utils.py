@@ -0,0 +1,35 @@
+import pytest
+from checkdp.transform.utils import branch_free
+
+
+@pytest.mark.parametrize('condition, expected', [
+    ('x == 0 || x == 1', '(x == 0) | (x == 1)'),
+    ('x == 0 && y != 1', '(x == 0) & (y != 1)'),
+    ('x == 0 && (y < 1 || y > 2)', '(x == 0) & ((y < 1) | (y > 2))'),
+    ('(a < b && b <= c) || -a >= c * 2 - 1', '((a < b) & (b <= c)) | ((-a) >= ((c * 2) - 1))'),
+])
+def test_branch_free(condition, expected):
+    assert branch_free(condition) == expected
+    # the parsed expressions are cached, the rewrite must not modify the cached node
+    assert branch_free(condition) == expected
+
+
+@pytest.mark.parametrize('condition', [
+    # no logical operators
+    'x == 0',
+    # operands which are not comparisons
+    'x || y',
+    'x == 0 || y',
+    # array accesses, function calls and divisions might trap, therefore they must stay short-circuited
+    'q[0] == 0 || x == 1',
+    'x == 0 && (y < 1 || q[i] > 2)',
+    'f(x) == 0 || x == 1',
+    'x / 2 == 0 || x == 1',
+    'x == 0 && (y < 1 || 2 / y > 2)',
+    # conditions that cannot be parsed, or are not a single expression
+    'x == 0 || ',
+    'x === 1 || y == 2',
+    'x == 0 || y == 1; z == 2',
+])
+def test_branch_free_unchanged(condition):
+    assert branch_free(condition) == condition